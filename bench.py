@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+import cats
+
+
+# Synthetic categories: every node gets `fanout` children until `rows` is reached
+def make_categories(rows, fanout=10):
+    data = list()
+    queue = [(None, '')]
+    next_id = 1
+    while queue and next_id <= rows:
+        parent_id, parent_path = queue.pop(0)
+        for i in range(fanout):
+            if next_id > rows:
+                break
+            name = f"Cat {next_id}"
+            path = parent_path + '/' + name
+            data.append(cats.TransactionCat(id=next_id, parent_id=parent_id, name=name, path=path))
+            queue.append((next_id, path))
+            next_id += 1
+    return data
+
+
+# Writes an indented category CSV in the format the_maury_povich_show reads.
+# Trees are written depth first: each category below `depth` levels gets
+# between 1 and `fanout` children, and new top level categories are started
+# until `rows` lines have been written. groups maps group name -> weight.
+def write_csv(file, rows, depth=4, fanout=8, groups=None, tag_ratio=0.3, hidden_ratio=0.1, seed=0):
+    rnd = random.Random(seed)
+    groups = groups or {'Group A': 1}
+    names = list(groups)
+    weights = [groups[g] for g in names]
+    types = ['Type A', 'Type B', 'Type C']
+
+    with open(file, 'w', newline='') as f:
+        f.write("Category,Type,Description,Group,Tag,Hide\n")
+        count = 0
+        stack = list()
+        while count < rows:
+            if not stack:
+                stack.append((0, 1))
+            level, remaining = stack.pop()
+            if remaining > 1:
+                stack.append((level, remaining - 1))
+
+            count += 1
+            group = rnd.choices(names, weights)[0]
+            tag = f"Form {rnd.choice('ABCDEF')} T" if rnd.random() < tag_ratio else ''
+            hidden = 'H' if rnd.random() < hidden_ratio else ''
+            f.write(f"{'   ' * level}Cat {count},{rnd.choice(types)},Category {count},{group},{tag},{hidden}\n")
+
+            if level + 1 < depth:
+                stack.append((level + 1, rnd.randint(1, fanout)))
+    return file
+
+
+# Runs fn repeat times and records the best time for stage, which is less
+# noisy than a single run. Stages that change the database run once.
+def timed(results, repeat, stage, fn, *args, **kwargs):
+    best = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            value = fn(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+    results[stage] = round(best, 6)
+    return value
+
+
+def new_session(groups):
+    engine = create_engine("sqlite://")
+    cats.Base.metadata.create_all(engine)
+    session = Session(engine)
+    cats.build_tcg_table(session, list(groups))
+    return session
+
+
+# Times each stage of the pipeline on a generated CSV of `rows` lines, taking
+# the best of `repeat` runs. The ORM import is only timed up to orm_limit rows
+# since it gets very slow.
+def run_size(rows, workdir, orm_limit=100000, repeat=3, **csv_args):
+    groups = csv_args.get('groups') or {'Group A': 1}
+    file = write_csv(os.path.join(workdir, f"categories_{rows}.csv"), rows, **csv_args)
+    results = dict()
+
+    if rows <= orm_limit:
+        session = new_session(groups)
+        timed(results, 1, 'import_csv', cats.import_csv, session, file)
+        session.close()
+
+    session = new_session(groups)
+    timed(results, 1, 'import_csv_stream', cats.import_csv, session, file, stream=True)
+
+    data = timed(results, repeat, 'load_data', cats.load_data, session, show_hidden=True)
+    timed(results, repeat, 'load_data_group', cats.load_data, session, show_hidden=True, group=list(groups)[0])
+    tree = timed(results, repeat, 'setup_tree_model', cats.setup_tree_model, data)
+    timed(results, repeat, 'setup_tree_model_compact', cats.setup_tree_model, data, compact=True)
+    columns = timed(results, repeat, 'load_columns', cats.load_columns, session, show_hidden=True)
+    timed(results, repeat, 'setup_tree_model_columns', cats.setup_tree_model_columns, columns)
+    if cats.numpy is not None:
+        timed(results, repeat, 'export_numpy', cats.export_numpy, session, show_hidden=True)
+    if cats.pyarrow is not None:
+        timed(results, repeat, 'export_arrow', cats.export_arrow, session,
+              os.path.join(workdir, f"categories_{rows}.parquet"), show_hidden=True)
+
+    # a name about two thirds of the way through, and a pattern matching ~1%
+    name = data[len(data) * 2 // 3].name
+    pattern = r'^Cat \d*00$'
+    regex = lambda x, y: cats.re.search(x, y)
+    for mode in ['node', 'root', 'branch']:
+        timed(results, repeat, f'search_{mode}', tree.search, name=name, path=mode)
+        timed(results, repeat, f'search_{mode}_regex', tree.search, name=pattern, path=mode, comp=regex)
+    timed(results, repeat, 'iter_search', lambda: list(tree.iter_search(pattern)))
+
+    # building the index includes the sorted names and their trigram
+    # postings; the fuzzy lookups are misspelt names, one edit each, with
+    # max_distance 1 and with the default
+    def build_index():
+        index = tree.search_index()
+        index.fields['name'].sorted_strings()
+        index.fields['name'].postings()
+        return index
+    index = timed(results, repeat, 'search_index', build_index)
+    typos = [item.name[:-1] + 'x' for item in data[::max(1, len(data) // 100)]]
+    timed(results, repeat, 'search_prefix', lambda: [index.prefix(t[:6]) for t in typos])
+    timed(results, repeat, 'search_fuzzy', lambda: [index.fuzzy(t, max_distance=1) for t in typos])
+    timed(results, repeat, 'search_fuzzy_default', lambda: [index.fuzzy(t) for t in typos])
+
+    # one rule per ten categories on the category name, and one transaction
+    # per row whose payee is a random category name or an unknown payee
+    rnd = random.Random(0)
+    rules = [dict(category_id=item.id, payee=cats.re.escape(item.name) + r'\b', level=item.path.count('/'))
+             for item in data[::10]]
+    payees = [rnd.choice([item.name, 'Unknown payee']) for item in rnd.choices(data, k=len(data))]
+    transactions = [dict(payee=f"POS {p} 0042", amount=-rnd.randint(100, 100000), date='2026-01-01')
+                    for p in payees]
+    matcher = timed(results, repeat, 'rule_matcher', cats.RuleMatcher, rules)
+    timed(results, 1, 'categorize_transactions', cats.categorize_transactions, session, transactions, matcher)
+
+    timed(results, repeat, 'view_category_table', cats.view_category_table, data)
+    timed(results, repeat, 'view_descendent_hierarchy', cats.view_descendent_hierarchy, tree.root)
+    timed(results, repeat, 'view_category_search', cats.view_category_search, tree, name)
+
+    session.close()
+    return results
+
+
+def run_suite(sizes, orm_limit=100000, repeat=3, **csv_args):
+    report = dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        csv=csv_args,
+        results=dict(),
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in sizes:
+            print(f"Running {rows} rows", file=sys.stderr)
+            report['results'][str(rows)] = run_size(rows, workdir, orm_limit=orm_limit, repeat=repeat, **csv_args)
+    return report
+
+
+# Limits (stage -> seconds) checked on every run, on top of any --limit.
+# search_fuzzy_default is 100 lookups, so this is 1ms per lookup.
+DEFAULT_LIMITS = {'search_fuzzy_default': 0.1}
+
+
+# Stages slower than tolerance x the baseline, or over an absolute limit in
+# seconds. limits maps stage -> seconds and applies to every size. Stages
+# taking under min_seconds aren't compared with the baseline, as their
+# timings are mostly noise.
+def regressions(report, baseline=None, tolerance=1.5, limits=None, min_seconds=0.05):
+    failures = list()
+    for size, stages in report['results'].items():
+        base = (baseline or {}).get('results', {}).get(size, {})
+        for stage, seconds in stages.items():
+            if stage in base and seconds >= min_seconds and seconds > base[stage] * tolerance:
+                failures.append(f"{size} {stage}: {seconds:.3f}s vs baseline {base[stage]:.3f}s")
+            if limits and stage in limits and seconds > limits[stage]:
+                failures.append(f"{size} {stage}: {seconds:.3f}s over limit {limits[stage]:.3f}s")
+    return failures
+
+
+# Bytes allocated by setup_tree_model per node, not counting the data objects
+# handed to it
+def tree_memory(data, compact=False):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = cats.setup_tree_model(data, compact=compact)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(data)
+
+
+# "Group A:5,Group B:1" -> {'Group A': 5.0, 'Group B': 1.0}
+def parse_weights(text):
+    weights = dict()
+    for item in text.split(','):
+        name, _, weight = item.partition(':')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Category tree benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    memory = commands.add_parser('memory', help="bytes per node for each tree backend")
+    memory.add_argument('--rows', type=int, default=100000)
+    memory.add_argument('--fanout', type=int, default=10)
+
+    suite = commands.add_parser('suite', help="time import, load, tree build, search and views")
+    suite.add_argument('--sizes', default='1000,100000,1000000',
+                       help="comma separated row counts")
+    suite.add_argument('--depth', type=int, default=4)
+    suite.add_argument('--fanout', type=int, default=8)
+    suite.add_argument('--groups', default='Group A:4,Group B:2,Group C:1',
+                       help="group names and weights, e.g. 'Group A:4,Group B:1'")
+    suite.add_argument('--tag-ratio', type=float, default=0.3)
+    suite.add_argument('--hidden-ratio', type=float, default=0.1)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--orm-limit', type=int, default=100000,
+                       help="largest size to time the ORM import_csv at")
+    suite.add_argument('--output', help="write the JSON report here instead of stdout")
+    suite.add_argument('--baseline', help="JSON report from an earlier run to compare against")
+    suite.add_argument('--tolerance', type=float, default=1.5,
+                       help="fail if a stage takes more than this times the baseline")
+    suite.add_argument('--min-seconds', type=float, default=0.05,
+                       help="don't compare stages faster than this with the baseline")
+    suite.add_argument('--repeat', type=int, default=3,
+                       help="time each stage this many times and keep the best")
+    suite.add_argument('--limit', action='append', default=[], metavar='STAGE=SECONDS',
+                       help="fail if a stage takes longer than SECONDS at any size")
+    args = parser.parse_args(argv)
+
+    if args.command == 'memory':
+        data = make_categories(args.rows, args.fanout)
+        for name, compact in [('TreeModel', False), ('CompactTreeModel', True)]:
+            print(f"{name:20} {tree_memory(data, compact):8.1f} bytes/node")
+        return 0
+
+    report = run_suite(
+        [int(s) for s in args.sizes.split(',')],
+        orm_limit=args.orm_limit,
+        repeat=args.repeat,
+        depth=args.depth,
+        fanout=args.fanout,
+        groups=parse_weights(args.groups),
+        tag_ratio=args.tag_ratio,
+        hidden_ratio=args.hidden_ratio,
+        seed=args.seed,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    limits = dict(DEFAULT_LIMITS)
+    limits.update((k, float(v)) for k, _, v in (l.partition('=') for l in args.limit))
+    failures = regressions(report, baseline, args.tolerance, limits, args.min_seconds)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,14 +2,27 @@ from sqlalchemy import Column
 from sqlalchemy import Sequence
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
+from sqlalchemy import BigInteger
 from sqlalchemy import String
 from sqlalchemy import Boolean
 from sqlalchemy import create_engine
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy import bindparam
+from sqlalchemy import inspect
+from sqlalchemy import text
+from sqlalchemy import func
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy import literal
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql import expression, functions
@@ -19,8 +32,188 @@ import sqlalchemy.exc
 
 import sys
 import os
+import asyncio
+import json
+import mmap
+import struct
+import uuid
 import csv
 import re
+import bisect
+import decimal
+import heapq
+import collections
+import threading
+import time
+import functools
+import itertools
+import tracemalloc
+import cProfile
+import pstats
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.ext.asyncio import AsyncSession
+except ImportError:
+    create_async_engine = AsyncSession = None
+
+
+# Opt-in instrumentation. Pipeline stages are wrapped in stage() blocks (or
+# the instrumented decorator), which do nothing unless enable_instrumentation
+# has been called. When enabled, each stage records its calls, wall time,
+# rows handled, SQL statements executed (counted from engine events, so N+1
+# query patterns show up) and, with memory=True, peak traced memory. Nested
+# stages are counted in their parents too. callback, if given, is called with
+# a StageStats for every finished stage call.
+class StageStats:
+    __slots__ = ('name', 'calls', 'seconds', 'rows', 'statements', 'peak_memory')
+
+    def __init__(self, name, calls=0, seconds=0.0, rows=0, statements=0, peak_memory=0):
+        self.name = name
+        self.calls = calls
+        self.seconds = seconds
+        self.rows = rows
+        self.statements = statements
+        self.peak_memory = peak_memory
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Instrumentation:
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.stages = dict()
+        self.statements = 0
+        self._stack = list()
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def record(self, stats):
+        total = self.stages.get(stats.name)
+        if total is None:
+            total = self.stages[stats.name] = StageStats(stats.name)
+        total.calls += 1
+        total.seconds += stats.seconds
+        total.rows += stats.rows or 0
+        total.statements += stats.statements
+        total.peak_memory = max(total.peak_memory, stats.peak_memory)
+        if self.callback is not None:
+            self.callback(stats)
+
+    def report(self):
+        return [s.as_dict() for s in self.stages.values()]
+
+    def format(self):
+        lines = [f"{'stage':32}{'calls':>8}{'seconds':>12}{'rows':>10}{'sql':>8}{'peak KiB':>11}"]
+        for s in self.stages.values():
+            lines.append(f"{s.name:32}{s.calls:>8}{s.seconds:>12.4f}{s.rows:>10}{s.statements:>8}{s.peak_memory // 1024:>11}")
+        return '\n'.join(lines)
+
+
+class _Stage:
+    __slots__ = ('inst', 'stats', 'start', 'statements', 'base', 'peak')
+
+    def __init__(self, inst, name):
+        self.inst = inst
+        self.stats = StageStats(name, calls=1)
+
+    def __enter__(self):
+        inst = self.inst
+        if inst.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak counter is about to be reset, so hand what it saw to
+            # the enclosing stage first
+            if inst._stack:
+                inst._stack[-1].peak = max(inst._stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak = current
+        inst._stack.append(self)
+        self.statements = inst.statements
+        self.start = time.perf_counter()
+        return self.stats
+
+    def __exit__(self, *exc):
+        inst = self.inst
+        self.stats.seconds = time.perf_counter() - self.start
+        self.stats.statements = inst.statements - self.statements
+        inst._stack.pop()
+        if inst.memory and tracemalloc.is_tracing():
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            self.stats.peak_memory = peak - self.base
+            if inst._stack:
+                inst._stack[-1].peak = max(inst._stack[-1].peak, peak)
+        inst.record(self.stats)
+        return False
+
+
+class _NoStage:
+    def __enter__(self):
+        return StageStats(None)
+
+    def __exit__(self, *exc):
+        return False
+
+
+_instrumentation = None
+_no_stage = _NoStage()
+
+
+def enable_instrumentation(callback=None, memory=False):
+    global _instrumentation
+    disable_instrumentation()
+    _instrumentation = Instrumentation(callback=callback, memory=memory)
+    event.listen(Engine, 'before_cursor_execute', _instrumentation.count_statement)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return _instrumentation
+
+
+def disable_instrumentation():
+    global _instrumentation
+    if _instrumentation is not None:
+        event.remove(Engine, 'before_cursor_execute', _instrumentation.count_statement)
+    inst, _instrumentation = _instrumentation, None
+    return inst
+
+
+def stage(name):
+    if _instrumentation is None:
+        return _no_stage
+    return _Stage(_instrumentation, name)
+
+
+# Decorator form of stage(). rows, if given, works out the row count from the
+# return value.
+def instrumented(name, rows=None):
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if _instrumentation is None:
+                return fn(*args, **kwargs)
+            with _Stage(_instrumentation, name) as stats:
+                result = fn(*args, **kwargs)
+                if rows is not None:
+                    stats.rows = rows(result)
+                return result
+        return inner
+    return wrap
 
 
 Base = declarative_base()
@@ -42,19 +235,32 @@ class CategoryGroup(Base):
 class Category(Base):
     __tablename__ = "category"
     id = Column(Integer, Sequence('category_id_seq'), primary_key=True)
-    parent_id = Column(Integer, ForeignKey(id))
+    parent_id = Column(Integer, ForeignKey(id), index=True)
     name = Column(String(50), nullable=False)
     # Type: Type A, Type B, Type C
     # TODO: lookup table for types or validation?
     type = Column(String(50), nullable=False)
     description = Column(String(50))
     # group: Group A, Group B, Group C, Group D, Group E, Group F, Group G
-    group_id = Column(Integer, ForeignKey('category_group.id'), nullable=False)
+    group_id = Column(Integer, ForeignKey('category_group.id'), nullable=False, index=True)
     # TODO: if tag is set, has_tag must be True
     has_tag = Column(Boolean(), default=False)
     # TODO: create table for tags
-    tag = Column(String(50))
+    tag = Column(String(50), index=True)
     hidden = Column(Boolean(), default=False)
+    # Materialized path, e.g. '/Cat 1/Cat 1.1'. Kept up to date by the import
+    # and add/modify/delete functions so subtree, ancestor and prefix lookups
+    # are plain index range scans instead of a recursive CTE. Those ranges
+    # (see subtree_range) and ordering by path need paths compared byte by
+    # byte, so PostgreSQL uses the "C" collation; on other databases the
+    # column's collation has to be binary too.
+    path = Column(String().with_variant(String(collation='C'), 'postgresql'), index=True)
+    # Nested set numbers: everything below a category has lft and rgt
+    # strictly between the category's own, so a subtree is one indexed lft
+    # range. Bulk changes renumber the table with NESTED_SET_GAP between
+    # numbers; single adds and moves are fitted into the gaps.
+    lft = Column(BigInteger, index=True)
+    rgt = Column(BigInteger)
 
     detail = (Column(Integer))
     group = relationship("CategoryGroup", back_populates="categories")
@@ -80,12 +286,14 @@ class Category(Base):
         self.tag = tag
         self.hidden = hidden
         self.parent = parent
+        self.path = category_path(parent.path if parent is not None else None, name)
 
     def __repr__(self):
-        return "<Category(name=%r, id=%r, parent_id=%r, type=%r, description=%r, group_id=%r, has_tag=%s, tag=%r, hidden=%r, detail=%r)>" % (
+        return "<Category(name=%r, id=%r, parent_id=%r, path=%r, type=%r, description=%r, group_id=%r, has_tag=%s, tag=%r, hidden=%r, detail=%r)>" % (
             self.name,
             self.id,
             self.parent_id,
+            self.path,
             self.type,
             self.description,
             self.group_id,
@@ -106,7 +314,91 @@ class Category(Base):
         )
 
 
+# Single row change counter for the category table. instance is set when the
+# row is created, so two databases at the same version can be told apart.
+# Every function that writes categories bumps version in its transaction;
+# category_version() is the stamp tree snapshots are keyed by.
+class CategoryVersion(Base):
+    __tablename__ = "category_version"
+    id = Column(Integer, primary_key=True)
+    instance = Column(String(32), nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<CategoryVersion(instance=%r, version=%r)>" % (self.instance, self.version)
+
+
+# A bank transaction. amount is in cents (negative for debits) and date is
+# an ISO 'YYYY-MM-DD' string. category_id is filled in by
+# categorize_transactions.
+class Transaction(Base):
+    __tablename__ = "bank_transaction"
+    id = Column(Integer, Sequence('bank_transaction_id_seq'), primary_key=True)
+    account = Column(String(50))
+    date = Column(String(10), index=True)
+    payee = Column(String(100))
+    description = Column(String(100))
+    amount = Column(Integer, nullable=False)
+    tag = Column(String(50))
+    category_id = Column(Integer, ForeignKey('category.id'), index=True)
+
+    def __repr__(self):
+        return "<Transaction(id=%r, date=%r, payee=%r, amount=%r, category_id=%r)>" % (
+            self.id, self.date, self.payee, self.amount, self.category_id)
+
+
+# Assigns transactions to category_id. Every condition that is set has to
+# hold: payee is a case-insensitive regex searched for in the payee (or the
+# description when there is no payee), min_amount/max_amount bound the
+# amount in cents, inclusive, and tag must equal the transaction's tag.
+class CategoryRule(Base):
+    __tablename__ = "category_rule"
+    id = Column(Integer, Sequence('category_rule_id_seq'), primary_key=True)
+    category_id = Column(Integer, ForeignKey('category.id'), nullable=False, index=True)
+    payee = Column(String(200))
+    min_amount = Column(Integer)
+    max_amount = Column(Integer)
+    tag = Column(String(50))
+
+    def __repr__(self):
+        return "<CategoryRule(category_id=%r, payee=%r, min_amount=%r, max_amount=%r, tag=%r)>" % (
+            self.category_id, self.payee, self.min_amount, self.max_amount, self.tag)
+
+
+def category_path(parent_path, name):
+    return (parent_path or '') + '/' + (name or '')
+
+
+# Range that matches every string starting with prefix. Unlike LIKE, sqlite
+# can answer this with an index range scan.
+def prefix_range(column, prefix):
+    if not prefix:
+        return expression.true()
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (column >= prefix) & (column < upper)
+
+
+# Every path strictly below path. '0' is the character after '/'. path may
+# be a string or another column.
+def subtree_range(column, path):
+    return (column >= path + '/') & (column < path + '0')
+
+
+# Space left between consecutive nested set numbers (see Category.lft)
+NESTED_SET_GAP = 1 << 16
+
+
+# Every lft strictly inside a category's (lft, rgt), i.e. its subtree. lft and
+# rgt may be numbers or columns.
+def nested_set_range(column, lft, rgt, include_self=False):
+    if include_self:
+        return column.between(lft, rgt)
+    return column.between(lft + 1, rgt - 1)
+
+
 class TransactionCat:
+    __slots__ = ('id', 'parent_id', 'name', 'path', 'type', 'description', 'group', 'has_tag', 'tag', 'hidden')
+
     def __init__(self, id=None, parent_id=None, name=None, path=None, type=None, description=None, group=None, has_tag=None, tag=None, hidden=False):
         self.id = id
         self.parent_id = parent_id
@@ -117,12 +409,16 @@ class TransactionCat:
         self.group = group
         self.has_tag = has_tag
         self.tag = tag
+        self.hidden = hidden
 
 
 # Adapted from 
 # https://code.qt.io/cgit/qt/qtbase.git/tree/examples/widgets/itemviews/simpletreemodel/treemodel.cpp?h=5.15
 # and .net TreeModel
 class Node:
+    __slots__ = ('parent', 'children', 'data', 'name', 'level', 'key', '_path_parts', '_fullpath',
+                 'descendants', 'own', 'totals', 'lft', 'rgt')
+
     def __init__(self, data=None, parent=None, name=None, level=0, key=None):
         self.parent = parent
         self.children = list()
@@ -130,15 +426,72 @@ class Node:
         self.name = name
         self.level = level
         self.key = key
+        # Caches for path_parts/fullpath, cleared by _reset_subtree whenever
+        # the node or one of its ancestors is renamed or moved. A node is only
+        # cached once all its ancestors are, so an uncached node never has
+        # cached descendants.
+        self._path_parts = None
+        self._fullpath = None
+        # Subtree aggregates: the number of nodes below this one, this node's
+        # own values (e.g. {'count': 3, 'amount': -4500}) and the same values
+        # summed over the node and everything below it. own and totals are
+        # None until there is something in them. Worked out in one pass by
+        # setup_tree_model and kept up to date along the ancestor chain when
+        # nodes are added, moved or removed.
+        self.descendants = 0
+        self.own = None
+        self.totals = None
+        # Nested set numbers (see TreeModel.number_nodes). None on the top
+        # node of a tree means they are out of date.
+        self.lft = None
+        self.rgt = None
+
+    # True if node is somewhere below this one. Only valid while the numbers
+    # are; TreeModel.is_ancestor brings them up to date first.
+    def is_ancestor_of(self, node):
+        return self.lft < node.lft and node.rgt < self.rgt
+
+    # Sum of key over this node's subtree
+    def total(self, key):
+        return self.totals.get(key, 0) if self.totals else 0
+
+    # Adds count descendants and values to the totals of this node and
+    # every ancestor; sign=-1 takes them away
+    def _propagate(self, count, values, sign=1):
+        node = self
+        while True:
+            node.descendants += sign * count
+            if values:
+                node.totals = add_values(node.totals, values, sign)
+            if node.parent is None:
+                break
+            node = node.parent
+        if count:
+            node.rgt = None
+
+    # Names from the top of the tree down to this node, e.g. ('Cat 1', 'Cat 1.1')
+    @property
+    def path_parts(self):
+        if self._path_parts is None:
+            chain = list()
+            node = self
+            while node._path_parts is None:
+                if node.parent is None:
+                    node._path_parts = ()
+                    break
+                chain.append(node)
+                node = node.parent
+            parts = node._path_parts
+            for n in reversed(chain):
+                parts = parts + (n.name,)
+                n._path_parts = parts
+        return self._path_parts
 
     @property
     def fullpath(self):
-        path = '/' + self.name
-        parent = self.parent
-        while parent.parent is not None:
-            path = '/' + parent.name + path
-            parent = parent.parent
-        self._fullpath = path
+        if self._fullpath is None:
+            parts = self.path_parts
+            self._fullpath = '/' + '/'.join(parts) if parts else ''
         return self._fullpath
 
     def iterate(self):
@@ -152,24 +505,181 @@ class Node:
     def add_node(self, node):
         #node = Node(data)
         print(f"Adding node: {node.name}")
-        node.parent = self
         #node.name = name
-        node.level = self.level+1
+        self._attach(node)
+
+    # add_node without the message, for moves
+    def _attach(self, node):
+        node.parent = self
+        node._reset_subtree()
         self.children.append(node)
+        self._propagate(node.descendants + 1, node.totals)
+
+    # Detach this node, taking its subtree with it
+    def remove(self):
+        if self.parent is not None:
+            self.parent.children.remove(self)
+            self.parent._propagate(self.descendants + 1, self.totals, -1)
+            self.parent = None
+
+    # Re-parent this node, taking its subtree with it
+    def move(self, parent):
+        p = parent
+        while p is not None:
+            if p is self:
+                raise ValueError(f"Cannot move {self.name} below itself")
+            p = p.parent
+        self.remove()
+        parent._attach(self)
+
+    def rename(self, name):
+        self.name = name
+        self._reset_subtree()
+
+    # Clear cached paths and fix levels below a renamed or moved node. Stops at
+    # nodes that have nothing cached and already have the right level.
+    def _reset_subtree(self):
+        if self.parent is not None:
+            self.level = self.parent.level + 1
+        self._path_parts = self._fullpath = None
+        stack = list(self.children)
+        while stack:
+            node = stack.pop()
+            # Handles borrowed from a CompactTreeModel work their own out
+            if not isinstance(node, Node):
+                continue
+            level = node.parent.level + 1
+            if node._path_parts is None and node._fullpath is None and node.level == level:
+                continue
+            node.level = level
+            node._path_parts = node._fullpath = None
+            stack.extend(node.children)
 
 # TODO: root 
 class TreeModel:
+    _search_index = None
+
     def __init__(self, indent=0):
         self._root = Node()
         self.index = self._root
         self.indent = indent
+        # Lookup tables filled in by index_node: key -> node,
+        # name -> [nodes] and full path -> node
+        self._by_key = dict()
+        self._by_name = dict()
+        self._by_path = dict()
 
     @property
     def root(self):
         return self._root
 
+    def __len__(self):
+        return len(self._by_path)
+
     def add_node(self, node=None):
         self._root.children.append(node)
+        node.parent = self._root
+        self._root._propagate(node.descendants + 1, node.totals)
+        self.index_node(node)
+
+    # Remove a node and everything below it
+    def remove_node(self, node):
+        for n in list(self._subtree(node)):
+            self._unindex_node(n)
+            if self._by_key.get(n.key) is n:
+                del self._by_key[n.key]
+        node.remove()
+
+    # Nested set numbers for every node: a counter that goes up by one on the
+    # way into and out of each node, depth first. setup_tree_model assigns
+    # them as it builds; after nodes are added, moved or removed they are
+    # redone here, in one pass, the next time they're needed.
+    def number_nodes(self):
+        if self._root.rgt is not None:
+            return
+        count = 0
+        stack = [(self._root, False)]
+        while stack:
+            node, done = stack.pop()
+            if done:
+                node.rgt = count
+            else:
+                node.lft = count
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+            count += 1
+
+    # True if a is above b in the tree
+    def is_ancestor(self, a, b):
+        self.number_nodes()
+        return a.is_ancestor_of(b)
+
+    # Add values (key -> number) to a node's own values and to the totals of
+    # the node and its ancestors, e.g. when a transaction is categorized
+    def add_values(self, node, values):
+        node.own = add_values(node.own, values)
+        node._propagate(0, values)
+
+    def index_node(self, node, path=None):
+        if path is None:
+            path = node.fullpath
+        self._search_index = None
+        if node.key is not None:
+            self._by_key[node.key] = node
+        self._by_name.setdefault(node.name, list()).append(node)
+        self._by_path[path] = node
+
+    def _unindex_node(self, node):
+        self._search_index = None
+        if self._by_path.get(node.fullpath) is node:
+            del self._by_path[node.fullpath]
+        nodes = self._by_name.get(node.name, [])
+        if node in nodes:
+            nodes.remove(node)
+
+    def _subtree(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children)
+
+    # Move or rename a node and keep the name and path indexes in step
+    def move_node(self, node, parent):
+        nodes = list(self._subtree(node))
+        for n in nodes:
+            self._unindex_node(n)
+        try:
+            node.move(parent)
+        finally:
+            for n in nodes:
+                self.index_node(n)
+
+    def rename_node(self, node, name):
+        nodes = list(self._subtree(node))
+        for n in nodes:
+            self._unindex_node(n)
+        try:
+            node.rename(name)
+        finally:
+            for n in nodes:
+                self.index_node(n)
+
+    def find_key(self, key):
+        return self._by_key.get(key)
+
+    def find_name(self, name):
+        return list(self._by_name.get(name, ()))
+
+    def find_path(self, path):
+        return self._by_path.get(path)
+
+    # SearchIndex over the current nodes, built on first use and dropped
+    # whenever a node is indexed or unindexed
+    def search_index(self):
+        if self._search_index is None:
+            self._search_index = SearchIndex(self)
+        return self._search_index
 
     def fits_pattern(self, pattern, string):
         return re.search(pattern, string)
@@ -177,11 +687,34 @@ class TreeModel:
     def equal_pattern(self, pattern, string):
         return pattern == string
 
-    # TODO: define lambda search for key, for generic search, maybe with re's, instead of strict name
-    # TODO: define root, branch modes
+    # Yields every node below _node (default root) whose name matches pattern.
+    # The pattern is compiled once and nodes are produced as they are found.
+    # With prune, nodes below a match are skipped.
+    def iter_search(self, pattern, flags=0, _node=None, prune=False):
+        regex = re.compile(pattern, flags)
+        return self._walk(lambda n: regex.search(n.name), _node or self._root, prune=prune)
+
+    # Pre-order walk yielding nodes for which match(node) is true. With prune,
+    # the children of a matching node are not searched.
+    def _walk(self, match, node, prune=True):
+        stack = list(reversed(node.children))
+        while stack:
+            node = stack.pop()
+            if node.name is not None and match(node):
+                yield node
+                if prune:
+                    continue
+            stack.extend(reversed(node.children))
+
     # TODO: return values: return as trees, lists, nodes, define with arg param, or whatever is most convenient?
+    # key: match on node key instead of name
+    # comp: comp(name, node.name) decides a match, exact name by default
+    # path='node' returns the matching nodes. 'root' and 'branch' return the
+    # top of a TreeView showing the matches and their ancestors, and for
+    # 'branch' everything below each match, or None if nothing matched.
+    @instrumented('TreeModel.search')
     def search(self, name=None, key=None, path=None, comp=None, _node=None):
-        if name is None:
+        if name is None and key is None:
             return self._root
         if _node is None:
             _node = self._root
@@ -189,44 +722,787 @@ class TreeModel:
             path = 'node'
         if path not in ['node', 'root', 'branch']:
             raise ValueError("path must be 'node', 'full' or 'branch'")
+        exact = comp is None
         if comp is None:
-            comp = lambda x, y: x == y
-
-        # TODO: split function up into three different search functions for node, root and branch
-        # TODO: maybe return back to this function and define as tree
-        comp = lambda x, y: re.search(x, y)
-        if _node.name is not None and comp(name, _node.name):
-            if path == 'node':
-                return [_node]
-            # TODO: add deepcopy for new node
-            elif path == 'root':
-                return Node(data=_node.data, parent=None, name=_node.name, level=_node.level, key=_node.key)
-            elif path == 'branch':
-                n = Node(data=_node.data, parent=None, name=_node.name, level=_node.level, key=_node.key)
-                # TODO: shallow copy of children, or deep copy?
-                n.children = _node.children
-                return n
+            comp = self.equal_pattern
+
+        if key is not None:
+            match = lambda n: n.key == key
+        else:
+            match = lambda n: comp(name, n.name)
+
+        if path != 'node' and _node.name is not None and match(_node):
+            matches = [_node]
+        # Exact lookups are answered from the indexes
+        elif _node is self._root and key is not None:
+            node = self.find_key(key)
+            matches = [node] if node is not None else []
+        elif _node is self._root and exact:
+            matches = [n for n in self.find_name(name) if not self._below_name(n, name)]
+        else:
+            matches = list(self._walk(match, _node))
 
         if path == 'node':
-            nodes = list()
-            for child in _node.children:
-                retval = self.search(name=name, key=key, path=path, _node=child)
-                nodes += retval
-            return nodes
-        elif path == 'root':
-            n = Node(data=_node.data, parent=None, name=_node.name, level=_node.level, key=_node.key)
-            for child in _node.children:
-                retval = self.search(name=name, key=key, path=path, _node=child)
-                if retval is not None:
-                    n.add_node(retval)
-            return n if n.children else None
-        elif path == 'branch':
-            n = Node(data=_node.data, parent=None, name=_node.name, level=_node.level, key=_node.key)
-            for child in _node.children:
-                retval = self.search(name=name, key=key, path=path, _node=child)
-                if retval is not None:
-                    n.add_node(retval)
-            return n if n.children else None
+            return matches
+        return TreeView(_node, matches, branch=path == 'branch').root if matches else None
+
+    # True if an ancestor of node is also called name, i.e. node would not be
+    # reached by a pruned walk
+    def _below_name(self, node, name):
+        parent = node.parent
+        while parent is not None:
+            if parent.name == name:
+                return True
+            parent = parent.parent
+        return False
+
+
+# What a root or branch search found: the matching nodes and their ancestors
+# up to top and, for a branch search, everything below each match. The view
+# only builds the set of nodes it shows. ViewNode handles onto the tree's own
+# nodes are made as they're visited, and children lists are new on every
+# access, so nothing done to a view reaches the tree. copy() makes a separate
+# Node tree for changing.
+class TreeView:
+    def __init__(self, top, matches, branch=False):
+        self.top = top
+        self.branch = branch
+        self.matches = set(matches)
+        self.shown = set()
+        for node in self.matches:
+            while node is not None and node not in self.shown:
+                self.shown.add(node)
+                if node == top:
+                    break
+                node = node.parent
+        self.root = ViewNode(self, top, branch and top in self.matches)
+
+
+# Node of a TreeView. Reads through to the tree's node; parent and children
+# stay within the view. full is set at and below a branch search match, where
+# every child is shown.
+class ViewNode:
+    __slots__ = ('_view', '_node', '_full')
+
+    def __init__(self, view, node, full=False):
+        self._view = view
+        self._node = node
+        self._full = full
+
+    def __eq__(self, other):
+        return isinstance(other, ViewNode) and other._view is self._view and other._node == self._node
+
+    def __hash__(self):
+        return hash(self._node)
+
+    # The tree's node
+    @property
+    def node(self):
+        return self._node
+
+    @property
+    def name(self):
+        return self._node.name
+
+    @property
+    def key(self):
+        return self._node.key
+
+    @property
+    def level(self):
+        return self._node.level
+
+    @property
+    def data(self):
+        return self._node.data
+
+    @property
+    def path_parts(self):
+        return self._node.path_parts
+
+    @property
+    def fullpath(self):
+        return self._node.fullpath
+
+    @property
+    def parent(self):
+        view = self._view
+        if self._node == view.top:
+            return None
+        return ViewNode(view, self._node.parent, self._full and self._node not in view.matches)
+
+    @property
+    def children(self):
+        view = self._view
+        node = self._node
+        if self._full:
+            return [ViewNode(view, child, True) for child in node.children]
+        if node in view.matches:
+            return []
+        return [ViewNode(view, child, view.branch and child in view.matches)
+                for child in node.children if child in view.shown]
+
+    # The part of the tree this node shows as new Nodes, with their own
+    # subtree counts, totals and nested set numbers
+    def copy(self):
+        top = Node(data=self.data, name=self.name, level=self.level, key=self.key)
+        nodes = list()
+        values = dict()
+        stack = [(self, top)]
+        while stack:
+            view_node, n = stack.pop()
+            if n is not top:
+                nodes.append(n)
+                n.lft = 2 * len(nodes) - (n.level - top.level)
+            own = getattr(view_node.node, 'own', None)
+            if own:
+                values[n.key] = own
+            children = view_node.children
+            n.children = [Node(data=c.data, parent=n, name=c.name, level=c.level, key=c.key) for c in children]
+            stack.extend(reversed(list(zip(children, n.children))))
+        aggregate_nodes(nodes, values)
+        if values.get(top.key):
+            top.own = dict(values[top.key])
+            top.totals = add_values(top.totals, top.own)
+        top.lft = 0
+        top.rgt = 2 * len(nodes) + 1
+        return top
+
+
+# Node of a LazyTreeModel. Its children are fetched from the database the
+# first time they are accessed.
+class LazyNode(Node):
+    __slots__ = ('_tree', '_fetched')
+
+    def __init__(self, tree=None, **kwargs):
+        self._tree = tree
+        self._fetched = False
+        super().__init__(**kwargs)
+
+    @property
+    def children(self):
+        if not self._fetched and self._tree is not None:
+            self._tree.fetch_more(self)
+        return Node.children.__get__(self)
+
+    @children.setter
+    def children(self, value):
+        Node.children.__set__(self, value)
+
+
+# TreeModel that loads from the Category table on demand, in the manner of
+# Qt's canFetchMore/fetchMore, so startup cost doesn't depend on tree size.
+# Fetching a node's children also fetches those of its unfetched siblings in
+# the same query, so showing the first few levels costs one query per level.
+# The key/name/path indexes cover loaded nodes; find_* fall back to the
+# database for the rest. Anything that walks the whole tree (search,
+# iter_search) will load the whole tree.
+class LazyTreeModel(TreeModel):
+    def __init__(self, session, show_hidden=False, indent=0):
+        super().__init__(indent)
+        self.session = session
+        self.show_hidden = show_hidden
+        self._root = LazyNode(tree=self)
+        self.index = self._root
+
+    def can_fetch_more(self, node):
+        return not node._fetched
+
+    def fetch_more(self, node):
+        if node.parent is None:
+            nodes = [node]
+        else:
+            nodes = [n for n in Node.children.__get__(node.parent) if not n._fetched]
+        for n in nodes:
+            n._fetched = True
+
+        by_key = {n.key: n for n in nodes}
+        keys = list(by_key)
+        for i in range(0, len(keys), 500):
+            for row in self._query_children(keys[i:i+500]):
+                parent = by_key[row.parent_id]
+                data = TransactionCat(
+                    id = row.id,
+                    parent_id = row.parent_id,
+                    name = row.name,
+                    path = category_path(parent.data.path if parent.data else None, row.name),
+                    group = parent.data.group if parent.data else row.group,
+                    description = row.description,
+                    has_tag = row.has_tag,
+                    tag = row.tag,
+                    hidden = row.hidden)
+                n = LazyNode(tree=self, data=data, parent=parent, name=row.name, level=parent.level+1, key=row.id)
+                Node.children.__get__(parent).append(n)
+                self.index_node(n, data.path)
+
+    def _query_children(self, keys):
+        query = self.session.query(
+                Category.id,
+                Category.parent_id,
+                Category.name,
+                Category.description,
+                Category.has_tag,
+                Category.tag,
+                Category.hidden,
+                CategoryGroup.name.label('group'),
+            ) \
+            .filter(CategoryGroup.id == Category.group_id)
+        if keys == [None]:
+            query = query.filter(Category.parent_id == None)
+        else:
+            query = query.filter(Category.parent_id.in_(keys))
+        if self.show_hidden is False:
+            query = query.filter(Category.hidden.isnot(True))
+        return query.order_by(Category.parent_id, Category.name)
+
+    # Walks up from b instead of numbering, which would load the whole tree
+    def is_ancestor(self, a, b):
+        node = b.parent
+        while node is not None:
+            if node is a:
+                return True
+            node = node.parent
+        return False
+
+    def find_key(self, key):
+        node = super().find_key(key)
+        if node is None:
+            row = lookup_cache(self.session).category(key)
+            if row is not None and row['path'] is not None:
+                node = self.find_path(row['path'])
+        return node
+
+    def find_name(self, name):
+        for (path,) in self.session.query(Category.path).filter(Category.name == name):
+            if path is not None and path not in self._by_path:
+                self.find_path(path)
+        return super().find_name(name)
+
+    # Walks down from the root, fetching each level on the way
+    def find_path(self, path):
+        node = super().find_path(path)
+        if node is not None or not path:
+            return node
+        node = self._root
+        for part in path.split('/')[1:]:
+            node = next((c for c in node.children if c.name == part), None)
+            if node is None:
+                return None
+        return node
+
+
+# Read-only handle onto one node of a CompactTreeModel. Handles are created on
+# access and only hold the tree and the node's index.
+class CompactNode:
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and other._tree is self._tree and other._index == self._index
+
+    def __hash__(self):
+        return hash(self._index)
+
+    @property
+    def name(self):
+        return self._tree._name(self._index)
+
+    @property
+    def key(self):
+        return self._tree._key(self._index)
+
+    @property
+    def level(self):
+        return self._tree._level[self._index]
+
+    @property
+    def descendants(self):
+        return self._tree._descendant_count(self._index)
+
+    @property
+    def lft(self):
+        self._tree.number_nodes()
+        return self._tree._lft[self._index]
+
+    @property
+    def rgt(self):
+        self._tree.number_nodes()
+        return self._tree._rgt[self._index]
+
+    def is_ancestor_of(self, node):
+        return self.lft < node.lft and node.rgt < self.rgt
+
+    @property
+    def data(self):
+        return self._tree._data(self._index)
+
+    @property
+    def parent(self):
+        return self._tree._node(self._tree._parent[self._index])
+
+    @property
+    def children(self):
+        return [self._tree._node(i) for i in self._tree._child_indexes(self._index)]
+
+    @property
+    def path_parts(self):
+        tree = self._tree
+        parts = list()
+        i = self._index
+        while i > 0:
+            parts.append(tree._name(i))
+            i = tree._parent[i]
+        return tuple(reversed(parts))
+
+    @property
+    def fullpath(self):
+        parts = self.path_parts
+        return '/' + '/'.join(parts) if parts else ''
+
+
+# Struct-of-arrays version of TreeModel for very large trees. Each node is a
+# slot in a set of parallel arrays (parent, first child, next sibling, level,
+# interned name id, key); index 0 is the root. Nodes are handed out as
+# CompactNode handles, so search/root/children work as on TreeModel, but the
+# tree is read-only and doesn't keep the loaded data objects.
+# find_name is a scan over the name id array and find_path walks down from
+# the root, in exchange for not keeping per-node dicts.
+class CompactTreeModel(TreeModel):
+    def __init__(self, indent=0):
+        self.indent = indent
+        self._parent = array('i', [-1])
+        self._first_child = array('i', [-1])
+        self._next_sibling = array('i', [-1])
+        self._last_child = array('i', [-1])
+        self._level = array('i', [0])
+        self._name_ids = array('i', [-1])
+        self._keys = array('q', [0])
+        self._names = list()
+        self._name_lookup = dict()
+        self._key_order = array('i')
+        self._sorted_keys = None
+        self._descendants = None
+        self._lft = self._rgt = None
+        self._root = CompactNode(self, 0)
+        self.index = self._root
+
+    def __len__(self):
+        return len(self._parent) - 1
+
+    def add_node(self, node=None):
+        raise NotImplementedError("CompactTreeModel is read-only")
+
+    def append_node(self, parent, name, key):
+        i = len(self._parent)
+        if name not in self._name_lookup:
+            self._name_lookup[name] = len(self._names)
+            self._names.append(name)
+        self._parent.append(parent)
+        self._first_child.append(-1)
+        self._next_sibling.append(-1)
+        self._last_child.append(-1)
+        self._level.append(self._level[parent] + 1)
+        self._name_ids.append(self._name_lookup[name])
+        self._keys.append(key)
+
+        if self._last_child[parent] < 0:
+            self._first_child[parent] = i
+        else:
+            self._next_sibling[self._last_child[parent]] = i
+        self._last_child[parent] = i
+        return i
+
+    # Called once all nodes are added: drops build-only state and sorts
+    # node indexes by key for find_key
+    def finish(self):
+        self._last_child = None
+        self._key_order = array('i', sorted(range(1, len(self._parent)), key=self._keys.__getitem__))
+        self._sorted_keys = None
+
+    def _node(self, i):
+        if i < 0:
+            return None
+        return self._root if i == 0 else CompactNode(self, i)
+
+    def _name(self, i):
+        n = self._name_ids[i]
+        return self._names[n] if n >= 0 else None
+
+    def _key(self, i):
+        return self._keys[i] if i > 0 else None
+
+    def _data(self, i):
+        return None
+
+    # Descendant counts for every node, worked out on first use. A node is
+    # always visited before its children, so the reverse visiting order
+    # reaches each node after everything below it.
+    def _descendant_count(self, i):
+        if self._descendants is None:
+            counts = array('i', bytes(4 * len(self._parent)))
+            order = list()
+            stack = [0]
+            while stack:
+                j = stack.pop()
+                order.append(j)
+                stack.extend(self._child_indexes(j))
+            for j in reversed(order[1:]):
+                counts[self._parent[j]] += counts[j] + 1
+            self._descendants = counts
+        return self._descendants[i]
+
+    # Nested set numbers for every node, worked out on first use
+    def number_nodes(self):
+        if self._lft is None:
+            lft, rgt = euler_numbers(self._parent, self._first_child, self._next_sibling)
+            self._lft = array('q', lft)
+            self._rgt = array('q', rgt)
+
+    def _child_indexes(self, i):
+        c = self._first_child[i]
+        while c >= 0:
+            yield c
+            c = self._next_sibling[c]
+
+    def index_node(self, node, path=None):
+        pass
+
+    # Binary search of the keys in key order, made on first use
+    def find_key(self, key):
+        if self._sorted_keys is None:
+            self._sorted_keys = array('q', [self._keys[i] for i in self._key_order])
+        j = bisect.bisect_left(self._sorted_keys, key)
+        if j < len(self._sorted_keys) and self._sorted_keys[j] == key:
+            return self._node(self._key_order[j])
+        return None
+
+    def find_name(self, name):
+        n = self._name_lookup.get(name)
+        if n is None:
+            return []
+        return [self._node(i) for i, v in enumerate(self._name_ids) if v == n]
+
+    def find_path(self, path):
+        i = 0
+        for part in path.split('/')[1:]:
+            n = self._name_lookup.get(part)
+            i = next((c for c in self._child_indexes(i) if self._name_ids[c] == n), -1)
+            if i < 0:
+                return None
+        return self._node(i) if i > 0 else None
+
+    def move_node(self, node, parent):
+        raise NotImplementedError("CompactTreeModel is read-only")
+
+    def rename_node(self, node, name):
+        raise NotImplementedError("CompactTreeModel is read-only")
+
+    def remove_node(self, node):
+        raise NotImplementedError("CompactTreeModel is read-only")
+
+    def add_values(self, node, values):
+        raise NotImplementedError("CompactTreeModel is read-only")
+
+
+# Padded trigrams of text, so that even one character strings have some
+def trigrams(text, pad=True):
+    if pad:
+        text = '\0\0' + text + '\0'
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+# Levenshtein distance between a and b, using Myers' bit-parallel algorithm
+# with one bit per character of the shorter string
+def edit_distance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    m = len(b)
+    if m == 0:
+        return len(a)
+    peq = dict()
+    for i, c in enumerate(b):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    top = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    for c in a:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & top:
+            score += 1
+        elif mh & top:
+            score -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    return score
+
+
+# The most candidates _TextIndex.fuzzy checks one by one; past this it walks
+# the whole index as a trie instead
+FUZZY_CANDIDATES = 5000
+
+
+# Case-insensitive index over one text field of the nodes (name or full
+# path). Each distinct casefolded string is stored once with the nodes that
+# have it. The sorted string order (for prefix queries), the trigram postings
+# (trigram -> string ids, for substring queries) and the characters used are
+# built the first time they are needed; fuzzy queries use all three.
+class _TextIndex:
+    def __init__(self):
+        self.strings = list()
+        self.nodes = list()
+        self._lookup = dict()
+        self._order = None
+        self._sorted = None
+        self._postings = None
+        self._by_rank = None
+        self._alphabet = None
+        self._lengths = None
+
+    def add(self, text, node):
+        text = text.casefold()
+        i = self._lookup.get(text)
+        if i is None:
+            i = self._lookup[text] = len(self.strings)
+            self.strings.append(text)
+            self.nodes.append([node])
+        else:
+            self.nodes[i].append(node)
+
+    def _expand(self, ids, limit):
+        found = list()
+        for i in ids:
+            found.extend(self.nodes[i])
+            if limit is not None and len(found) >= limit:
+                return found[:limit]
+        return found
+
+    # The strings in sorted order; _order holds their ids in the same order
+    def sorted_strings(self):
+        if self._order is None:
+            self._order = sorted(range(len(self.strings)), key=self.strings.__getitem__)
+            self._sorted = [self.strings[i] for i in self._order]
+        return self._sorted
+
+    # Strings starting with text, in sorted order. Found by bisecting the
+    # sorted strings, so the cost doesn't depend on how many match.
+    def prefix(self, text, limit=None):
+        self.sorted_strings()
+        text = text.casefold()
+        start = bisect.bisect_left(self._sorted, text)
+        ids = itertools.takewhile(lambda i: self.strings[i].startswith(text),
+                                  itertools.islice(self._order, start, None))
+        return self._expand(ids, limit)
+
+    # trigram -> ranks of the strings holding it, where strings are ranked by
+    # length, so each posting list is in length order too
+    def postings(self):
+        if self._postings is None:
+            self._by_rank = sorted(range(len(self.strings)), key=lambda i: len(self.strings[i]))
+            self._lengths = [len(self.strings[i]) for i in self._by_rank]
+            postings = dict()
+            for rank, i in enumerate(self._by_rank):
+                for gram in trigrams(self.strings[i]):
+                    postings.setdefault(gram, list()).append(rank)
+            self._postings = postings
+        return self._postings
+
+    # Strings containing text, matches at the start first, then shorter
+    # strings first. Only strings holding the rarest trigram of text are
+    # checked.
+    def substring(self, text, limit=None):
+        text = text.casefold()
+        if len(text) < 3:
+            candidates = range(len(self.strings))
+        else:
+            postings = self.postings()
+            rarest = min((postings.get(g, ()) for g in trigrams(text, pad=False)), key=len)
+            candidates = (self._by_rank[r] for r in rarest)
+        ranked = list()
+        for i in candidates:
+            pos = self.strings[i].find(text)
+            if pos >= 0:
+                ranked.append((pos > 0, len(self.strings[i]), self.strings[i], i))
+        ranked = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+        return self._expand((r[-1] for r in ranked), limit)
+
+    # (distance, node) for strings within max_distance edits of text, closest
+    # first. With a limit, nearer strings are looked for first: once limit
+    # nodes are within some distance, nothing further away can make the cut,
+    # so a close match usually never needs the max_distance search.
+    def fuzzy(self, text, limit=None, max_distance=2):
+        text = text.casefold()
+        distances = range(max_distance + 1) if limit is not None else [max_distance]
+        for distance in distances:
+            matches = self.within(text, distance)
+            if limit is None or sum(len(self.nodes[i]) for d, i in matches) >= limit:
+                break
+        ranked = list()
+        for d, i in matches:
+            s = self.strings[i]
+            ranked.append((d, abs(len(s) - len(text)), s, i))
+        ranked = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+        found = list()
+        for d, _, _, i in ranked:
+            found.extend((d, node) for node in self.nodes[i])
+        return found[:limit] if limit is not None else found
+
+    # (distance, id) for every string within max_distance edits of text.
+    # Up to one edit, every string that far from text is made and looked up.
+    # Further than that, candidates come from the trigram postings and are
+    # checked with edit_distance; when the trigrams don't narrow things down
+    # to FUZZY_CANDIDATES strings (short text, or strings that mostly share a
+    # prefix) the sorted strings are searched with walk instead.
+    def within(self, text, max_distance):
+        if max_distance == 0:
+            i = self._lookup.get(text)
+            return [(0, i)] if i is not None else []
+        if max_distance == 1:
+            return [(int(i != self._lookup.get(text)), i) for i in self.neighbours(text)]
+        candidates = self.near(text, max_distance)
+        if candidates is None:
+            matches = self.walk(text, max_distance)
+        else:
+            matches = ((edit_distance(text, self.strings[i]), i) for i in candidates)
+        return [(d, i) for d, i in matches if d <= max_distance]
+
+    # Ids of the strings at most one insertion, deletion or substitution from
+    # text, using only characters that occur in some string
+    def neighbours(self, text):
+        if self._alphabet is None:
+            self._alphabet = ''.join(set(''.join(self.strings)))
+        edits = set()
+        for k in range(len(text) + 1):
+            head, tail = text[:k], text[k:]
+            rest = tail[1:]
+            if tail:
+                edits.add(head + rest)
+            for c in self._alphabet:
+                edits.add(head + c + tail)
+                if tail:
+                    edits.add(head + c + rest)
+        edits.add(text)
+        lookup = self._lookup
+        return [lookup[s] for s in edits if s in lookup]
+
+    # Ids of the strings that may be within max_distance edits of text, or
+    # None if there are more than FUZZY_CANDIDATES. Each edit changes at most
+    # three trigrams, so a match has all but 3 * max_distance of the trigrams
+    # of text, and at least n - 3 * max_distance of any n of their posting
+    # lists hold it. Only the parts of the lists for strings of a possible
+    # length are read: the rarest 3 * max_distance + 1 of them, plus any more
+    # that are no longer than those already read, raising the count needed.
+    def near(self, text, max_distance):
+        grams = trigrams(text)
+        need = len(grams) - 3 * max_distance
+        postings = self.postings()
+        lo = bisect.bisect_left(self._lengths, len(text) - max_distance)
+        hi = bisect.bisect_right(self._lengths, len(text) + max_distance)
+        if need <= 0:
+            return self._by_rank[lo:hi] if hi - lo <= FUZZY_CANDIDATES else None
+
+        spans = list()
+        for gram in grams:
+            ranks = postings.get(gram, ())
+            start = bisect.bisect_left(ranks, lo)
+            spans.append((bisect.bisect_left(ranks, hi, start) - start, start, ranks))
+        spans.sort(key=lambda span: span[0])
+        used = 3 * max_distance + 1
+        read = sum(span[0] for span in spans[:used])
+        while used < len(spans) and spans[used][0] <= read:
+            read += spans[used][0]
+            used += 1
+        counts = collections.Counter()
+        for size, start, ranks in spans[:used]:
+            counts.update(ranks[start:start + size])
+        hits = used - 3 * max_distance
+        candidates = [self._by_rank[rank] for rank, count in counts.items() if count >= hits]
+        return candidates if len(candidates) <= FUZZY_CANDIDATES else None
+
+    # (distance, id) for every string within max_distance edits of text,
+    # walking the sorted strings as a trie: rows[m] is the edit distance row
+    # for the first m characters of the current string, so strings sharing a
+    # prefix reuse its rows, and once every entry of a row is over
+    # max_distance all strings with that prefix are skipped with one bisect.
+    # Only the cells within max_distance of the diagonal are worked out; the
+    # rest can't be in range and are left at max_distance + 1.
+    def walk(self, text, max_distance):
+        strings = self.sorted_strings()
+        n = len(text)
+        over = max_distance + 1
+        rows = [[min(j, over) for j in range(n + 1)]]
+        current = ''
+        k = 0
+        while k < len(strings):
+            s = strings[k]
+            m = 0
+            top = min(len(s), len(rows) - 1)
+            while m < top and s[m] == current[m]:
+                m += 1
+            del rows[m + 1:]
+            current = s
+            while m < len(s):
+                c = s[m]
+                prev = rows[m]
+                m += 1
+                row = [over] * (n + 1)
+                lo = max(0, m - max_distance)
+                hi = min(n, m + max_distance)
+                if lo == 0:
+                    row[0] = m
+                    lo = 1
+                for j in range(lo, hi + 1):
+                    row[j] = min(prev[j] + 1, row[j - 1] + 1, prev[j - 1] + (text[j - 1] != c))
+                rows.append(row)
+                if min(row) > max_distance:
+                    break
+            else:
+                yield rows[-1][n], self._order[k]
+                k += 1
+                continue
+            prefix = s[:m]
+            k = bisect.bisect_left(strings, prefix[:-1] + chr(ord(prefix[-1]) + 1), k)
+
+
+# Name and full path search over every node of a tree, made with
+# TreeModel.search_index(). field is 'name' or 'path' and results are nodes
+# of the tree, best first, at most limit of them:
+#
+#   index = tree.search_index()
+#   index.prefix('cat 1.')                      autocomplete
+#   index.substring('1.1', field='path')
+#   index.fuzzy('cta 1.2', max_distance=1)      [(distance, node), ...]
+#
+# A fuzzy lookup that finds limit matches within one edit takes well under a
+# millisecond. One that has to look two edits away, among many names that
+# differ only in a few characters, reads much more of the index: about
+# 0.15-0.3s on 200k names like 'Cat 123456'. Pass max_distance=1 where that
+# matters. Indexing a LazyTreeModel fetches the whole tree.
+class SearchIndex:
+    def __init__(self, tree):
+        self.fields = dict(name=_TextIndex(), path=_TextIndex())
+        for level, node in iter_descendants(tree.root):
+            self.fields['name'].add(node.name or '', node)
+            self.fields['path'].add(node.fullpath, node)
+
+    def prefix(self, text, field='name', limit=10):
+        return self.fields[field].prefix(text, limit)
+
+    def substring(self, text, field='name', limit=10):
+        return self.fields[field].substring(text, limit)
+
+    def fuzzy(self, text, field='name', limit=10, max_distance=2):
+        return self.fields[field].fuzzy(text, limit, max_distance)
 
 
 def build_tcg_table(session, names):
@@ -237,7 +1513,7 @@ def build_tcg_table(session, names):
     session.commit()
 
 
-def create_new_category(cat, groups):
+def parse_category_row(cat, groups):
     cat.pop(None, None)
 
     cat = {k: (v.strip() if v is not None else None) for k, v in cat.items()}
@@ -260,7 +1536,11 @@ def create_new_category(cat, groups):
 
     cat['hidden']=True if cat['hidden'] == 'H' else False
 
-    return Category(**cat)
+    return cat
+
+
+def create_new_category(cat, groups):
+    return Category(**parse_category_row(cat, groups))
 
 
 def read_csv(file=None, fieldnames=None):
@@ -273,151 +1553,725 @@ def read_csv(file=None, fieldnames=None):
         exit()
 
 
-def the_maury_povich_show(data, groups):
-    # AKA, who's your daddy?
-    ilen = 3
-    level = indent = 0
-    parent = None
-    root = children = list()
+# Same as read_csv, but yields one row at a time so the file is never held in memory
+def iter_csv(file=None, fieldnames=None):
+    try:
+        with open(file, newline='') as csvfile:
+            yield from csv.DictReader(csvfile, delimiter=',', quotechar='"', fieldnames=fieldnames)
+    except FileNotFoundError as err:
+        print(f"Cannot open file {file}")
+        exit()
 
-    for r in data:
-        name = r['name']
-        indent = len(name) - len(name.lstrip())
-        newlevel = int(indent / ilen)
 
-        node = create_new_category(r, groups)
+# Malformed indentation in a category file. line is the 1-based line number.
+class HierarchyError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+# Indentation parser for category files. Yields (row, parent_index, level)
+# for each row, where parent_index is the position of the parent among the
+# rows yielded so far (-1 at the top level). No ORM objects are made, so it
+# can validate or preview a file without a database.
+#   name        index or key of the category name in each row
+#   indent      spaces per level, '\t' for tabs, or None to use whatever the
+#               first indented row uses
+#   on_error    called with a HierarchyError for each bad row, which is
+#               skipped; without it the first error is raised
+#   first_line  line number of the first row, e.g. 2 after a header
+# stack[n] holds the index of the most recent row at level n.
+def parse_hierarchy(rows, name=0, indent=None, on_error=None, first_line=1):
+    if isinstance(indent, int):
+        char, width = ' ', indent
+    elif indent is not None:
+        char, width = indent[0], len(indent)
+    else:
+        char = width = None
+    stack = list()
+    index = 0
+
+    for line, row in enumerate(rows, first_line):
+        if not row:
+            continue
+        text = row[name] or ''
+        stripped = text.lstrip()
+        depth = len(text) - len(stripped)
+
+        if depth == 0:
+            error = None if stripped else "missing category name"
+            level = 0
+        elif not stripped:
+            error = "missing category name"
+        else:
+            whitespace = text[:depth]
+            if width is None:
+                char, width = whitespace[0], depth
+            if whitespace.count(char) != depth:
+                error = "mixed tabs and spaces" if char in whitespace else f"indented with {whitespace[0]!r}, expected {char!r}"
+            elif depth % width:
+                error = f"indent of {depth} is not a multiple of {width}"
+            else:
+                level = depth // width
+                skipped = level - len(stack)
+                error = None if skipped <= 0 else f"skips {skipped} level{'s' if skipped > 1 else ''}"
+
+        if error is not None:
+            err = HierarchyError(line, f"{error}: {stripped or text!r}")
+            if on_error is None:
+                raise err
+            on_error(err)
+            continue
 
-        if newlevel == level:
-            children.append(node)
-        elif newlevel == level+1:
-            parent = sibling
-            children = parent.children
-            children.append(node)
-        elif newlevel < level:
-            for i in range(newlevel, level):
-                parent = getattr(parent, 'parent', None)
-            children = getattr(parent, 'children', root)
-            children.append(node)
-        sibling = node
-        level = newlevel
+        del stack[level:]
+        yield row, stack[-1] if stack else -1, level
+        stack.append(index)
+        index += 1
+
+
+# parse_hierarchy over a category CSV file, with rows as lists of fields
+def read_hierarchy(file, indent=None, on_error=None, has_header=True):
+    with open(file, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        if has_header:
+            next(reader, None)
+        yield from parse_hierarchy(reader, 0, indent, on_error, first_line=2 if has_header else 1)
+
+
+def the_maury_povich_show(data, groups, first_line=1):
+    # AKA, who's your daddy?
+    root = list()
+    nodes = list()
+
+    for r, parent, level in parse_hierarchy(data, name='name', on_error=print, first_line=first_line):
+        node = create_new_category(r, groups)
+        if parent < 0:
+            root.append(node)
+            node.path = category_path(None, node.name)
+        else:
+            nodes[parent].children.append(node)
+            node.path = category_path(nodes[parent].path, node.name)
+        nodes.append(node)
 
     return root
 
 
-def import_csv(session, file):
+# Returns the number of categories imported
+def import_csv(session, file, stream=False, batch_size=5000):
     has_header=True
     fieldnames = ['name','type','description','category_group','tag','hidden']
 
-    groups = dict()
-    for g in session.query(CategoryGroup):
-        groups[g.name] = g.id
+    with stage('import_csv') as stats:
+        groups = lookup_cache(session).groups()
 
-    data = read_csv(file, fieldnames)
-    if has_header:
-        data = data[1:]
-    categories = the_maury_povich_show(data, groups)
-    session.add_all(categories)
+        if stream:
+            rows = iter_csv(file, fieldnames)
+            if has_header:
+                next(rows, None)
+            stats.rows = stream_categories(session, rows, groups, batch_size=batch_size,
+                                           first_line=2 if has_header else 1)
+            bump_category_version(session)
+            with stage('import_csv.commit'):
+                session.commit()
+            return stats.rows
+
+        with stage('read_csv') as s:
+            data = read_csv(file, fieldnames)
+            if has_header:
+                data = data[1:]
+            s.rows = len(data)
+        with stage('the_maury_povich_show') as s:
+            categories = the_maury_povich_show(data, groups, first_line=2 if has_header else 1)
+            session.add_all(categories)
+            s.rows = stats.rows = len(session.new)
+        renumber_categories(session)
+        bump_category_version(session)
+        with stage('import_csv.commit'):
+            session.commit()
+        return stats.rows
+
+
+# Yields (level, category dict) for each CSV row, with the full path worked
+# out from the indentation. Rows with bad indentation are passed to on_error
+# as a HierarchyError and skipped. paths[n] holds the path of the most recent
+# category at level n.
+def iter_hierarchy(rows, groups, first_line=1, on_error=print):
+    paths = list()
+
+    for r, parent, level in parse_hierarchy(rows, name='name', on_error=on_error, first_line=first_line):
+        cat = parse_category_row(r, groups)
+        cat['path'] = category_path(paths[level-1] if level > 0 else None, cat['name'])
+        del paths[level:]
+        paths.append(cat['path'])
+        yield level, cat
+
+
+# Streaming version of the_maury_povich_show + session.add_all.
+# Returns the number of categories inserted.
+# Ids are handed out here instead of by the database, so a child's parent_id
+# is known as soon as the parent row is read and nothing has to be flushed.
+# parents[n] holds the id of the most recent category at level n.
+# Nested set numbers carry on, gap apart, from the highest already in the
+# table. Each row is held back until the next one shows whether it has
+# children: leaves are inserted with both numbers, and categories with
+# children get their rgt by UPDATE once everything below them has been read.
+@instrumented('stream_categories', rows=lambda n: n)
+def stream_categories(session, rows, groups, batch_size=5000, first_line=1, gap=NESTED_SET_GAP):
+    table = Category.__table__
+    next_id = (session.query(func.max(Category.id)).scalar() or 0) + 1
+    number = (session.execute(select(func.max(table.c.rgt))).scalar() or 0) + gap
+    set_rgt = update(table).where(table.c.id == bindparam('_id')).values(rgt=bindparam('_rgt'))
+    parents = list()
+    waiting = list()    # (level, id) of categories with children, until they're left
+    held = None         # (level, category) of the last row read
+    batch = list()
+    rgts = list()
+    count = 0
+
+    rows = itertools.chain(iter_hierarchy(rows, groups, first_line), [(0, None)])
+    for level, cat in rows:
+        if held is not None:
+            held_level, held_cat = held
+            if level > held_level:
+                waiting.append((held_level, held_cat['id']))
+            else:
+                held_cat['rgt'] = number
+                number += gap
+            batch.append(held_cat)
+        while waiting and waiting[-1][0] >= level:
+            rgts.append(dict(_id=waiting.pop()[1], _rgt=number))
+            number += gap
+        if cat is None:
+            break
+
+        cat['id'] = next_id
+        cat['parent_id'] = parents[level-1] if level > 0 else None
+        cat['lft'] = number
+        number += gap
+        del parents[level:]
+        parents.append(next_id)
+        next_id += 1
+        held = (level, cat)
+
+        if len(batch) >= batch_size:
+            count += insert_categories(session, batch)
+            batch = list()
+            # every id in rgts has been inserted by now
+            for chunk in chunks(rgts, batch_size):
+                session.execute(set_rgt, chunk)
+            rgts = list()
+
+    if batch:
+        count += insert_categories(session, batch)
+    for chunk in chunks(rgts, batch_size):
+        session.execute(set_rgt, chunk)
+    return count
+
+
+# Bulk insert of plain category dicts through Core (executemany), bypassing the
+# ORM unit of work. Missing keys are inserted as NULL.
+@instrumented('insert_categories', rows=lambda n: n)
+def insert_categories(session, rows):
+    columns = ['id', 'parent_id', 'name', 'path', 'type', 'description', 'group_id', 'has_tag', 'tag', 'hidden',
+               'lft', 'rgt']
+    session.execute(
+        insert(Category.__table__),
+        [{c: r.get(c) for c in columns} for r in rows]
+    )
+    advance_category_sequence(session)
+    return len(rows)
+
+
+# The bulk imports and edits give out ids from max(id) + 1 themselves. Where
+# Category.id comes from a sequence (PostgreSQL), move the sequence past the
+# highest id so the next ORM insert doesn't reuse one. sqlite works out new
+# ids from the table and needs nothing. Other databases with sequences
+# (Oracle, Firebird) aren't handled.
+def advance_category_sequence(session):
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    table = Category.__table__
+    highest = select(func.max(table.c.id)).scalar_subquery()
+    session.execute(select(func.setval(table.c.id.default.name, highest)))
+
+
+# Import many CSV files (or every *.csv in a directory) at once. Files are
+# parsed and validated in a process pool; each worker sends back compact row
+# tuples with parent links as row indexes, and this process does the inserts
+# in batches. Files are handled in sorted order and ids are given out in
+# file then row order, so the result doesn't depend on which worker finishes
+# first. Files with errors are skipped. Returns one dict per file with its
+# row count, errors and parse/insert times in seconds.
+def import_csv_files(session, files, workers=None, batch_size=5000):
+    if isinstance(files, str) and os.path.isdir(files):
+        files = [os.path.join(files, f) for f in os.listdir(files) if f.lower().endswith('.csv')]
+    files = sorted(files)
+    groups = lookup_cache(session).groups()
+
+    if workers == 1 or len(files) < 2:
+        parsed = map(parse_csv_file, files, [groups] * len(files))
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        parsed = pool.map(parse_csv_file, files, [groups] * len(files))
+
+    next_id = (session.query(func.max(Category.id)).scalar() or 0) + 1
+    columns = ['parent_id', 'name', 'path', 'type', 'description', 'group_id', 'has_tag', 'tag', 'hidden']
+    results = list()
+    try:
+        for result in parsed:
+            rows = result.pop('rows')
+            results.append(result)
+            if result['errors']:
+                continue
+            start = time.perf_counter()
+            base = next_id
+            batch = list()
+            for i, row in enumerate(rows):
+                cat = dict(zip(columns, row))
+                cat['id'] = base + i
+                cat['parent_id'] = base + row[0] if row[0] >= 0 else None
+                batch.append(cat)
+                if len(batch) >= batch_size:
+                    insert_categories(session, batch)
+                    batch = list()
+            if batch:
+                insert_categories(session, batch)
+            next_id += len(rows)
+            result['insert_seconds'] = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    renumber_categories(session)
+    bump_category_version(session)
+    session.commit()
+    return results
+
+
+# Worker for import_csv_files. Rows come back as
+# (parent row index or -1, name, path, type, description, group_id, has_tag, tag, hidden)
+def parse_csv_file(file, groups):
+    start = time.perf_counter()
+    has_header=True
+    fieldnames = ['name','type','description','category_group','tag','hidden']
+
+    rows = list()
+    errors = list()
+    parents = list()
+    reader = iter_csv(file, fieldnames)
+    if has_header:
+        next(reader, None)
+    # Kept as text, with the line number, so the result pickles back from
+    # the worker
+    def bad_row(err):
+        errors.append(str(err))
+
+    for level, cat in iter_hierarchy(reader, groups, first_line=2 if has_header else 1, on_error=bad_row):
+        if cat.get('group_id') is None:
+            errors.append(f"{cat['path']}: no group")
+        if cat['type'] is None or cat['name'] is None:
+            errors.append(f"{cat['path']}: name and type are required")
+        del parents[level:]
+        parents.append(len(rows))
+        rows.append((
+            parents[level-1] if level > 0 else -1,
+            cat['name'],
+            cat['path'],
+            cat['type'],
+            cat['description'],
+            cat.get('group_id'),
+            cat['has_tag'],
+            cat['tag'],
+            cat['hidden'],
+        ))
+
+    return dict(file=file, rows=rows, count=len(rows), errors=errors,
+                parse_seconds=time.perf_counter() - start, insert_seconds=0.0)
+
+
+# Columns compared by sync_csv to decide whether a category changed
+SYNC_COLUMNS = ['name', 'type', 'description', 'group_id', 'has_tag', 'tag', 'hidden']
+
+
+# Re-import a CSV into a database that already holds an earlier version of
+# it. Rows are matched to categories by full path and compared by a hash of
+# SYNC_COLUMNS, and only the differences are written, in one transaction:
+#   inserted   path not in the database
+#   updated    same path, different attributes
+#   moved      path gone, but a new path has the same name and attributes;
+#              the category keeps its id and gets a new parent
+#   deleted    path no longer in the CSV (duplicate paths in the database
+#              are deleted too)
+# New and moved categories are fitted into the nested set by
+# place_nested_sets. Returns the count for each, plus unchanged.
+def sync_csv(session, file, batch_size=5000):
+    has_header=True
+    fieldnames = ['name','type','description','category_group','tag','hidden']
+    table = Category.__table__
+
+    groups = lookup_cache(session).groups()
+
+    # path -> (id, parent_id, hash) for everything in the database
+    existing = dict()
+    duplicates = list()
+    columns = [table.c.id, table.c.parent_id, table.c.path] + [table.c[c] for c in SYNC_COLUMNS]
+    for row in session.execute(select(*columns)):
+        if row.path in existing:
+            duplicates.append(row.id)
+            continue
+        existing[row.path] = (row.id, row.parent_id, hash(tuple(row[3:])))
+
+    rows = iter_csv(file, fieldnames)
+    if has_header:
+        next(rows, None)
+
+    next_id = (session.query(func.max(Category.id)).scalar() or 0) + 1
+    ids = dict()            # path -> id for every row in the CSV
+    parents = list()        # id (or path, if new) of the latest category at each level
+    inserts = list()
+    updates = list()
+    new_rows = list()       # rows whose path isn't in the database
+    placed = list()         # ids inserted or given another parent, for place_nested_sets
+    counts = dict(inserted=0, updated=0, moved=0, deleted=0, unchanged=0)
+
+    for level, cat in iter_hierarchy(rows, groups, first_line=2 if has_header else 1):
+        path = cat['path']
+        if path in ids:
+            print(f"Skipping duplicate category: {path}")
+            continue
+        parent_id = parents[level-1] if level > 0 else None
+        values = {c: cat.get(c) for c in SYNC_COLUMNS}
+
+        old = existing.pop(path, None)
+        if old is None:
+            new_rows.append((path, parent_id, values))
+            id = None
+        else:
+            id, old_parent_id, old_hash = old
+            if old_hash != hash(tuple(values.values())) or old_parent_id != parent_id:
+                updates.append(dict(values, _id=id, parent_id=parent_id))
+                counts['updated'] += 1
+                if old_parent_id != parent_id:
+                    placed.append(id)
+            else:
+                counts['unchanged'] += 1
+
+        ids[path] = id
+        del parents[level:]
+        parents.append(id if id is not None else path)
+
+    # Categories left in existing have gone from the CSV. Any with the same
+    # name and attributes as a new row are treated as moved rather than
+    # deleted and re-inserted.
+    gone = dict()
+    for path, (id, parent_id, h) in existing.items():
+        gone.setdefault(h, list()).append(id)
+    for path, parent_id, values in new_rows:
+        candidates = gone.get(hash(tuple(values.values())))
+        if candidates:
+            id = candidates.pop()
+            updates.append(dict(values, _id=id, parent_id=parent_id, path=path))
+            counts['moved'] += 1
+            placed.append(id)
+        else:
+            id = next_id
+            next_id += 1
+            inserts.append(dict(values, id=id, parent_id=parent_id, path=path))
+            counts['inserted'] += 1
+            placed.append(id)
+        ids[path] = id
+
+    # Parents that were new when their children were read are recorded by
+    # path; swap in the ids they were given
+    for row in inserts + updates:
+        if isinstance(row['parent_id'], str):
+            row['parent_id'] = ids[row['parent_id']]
+
+    deletes = duplicates + [id for gone_ids in gone.values() for id in gone_ids]
+    counts['deleted'] = len(deletes)
+
+    for i in range(0, len(inserts), batch_size):
+        insert_categories(session, inserts[i:i+batch_size])
+    for i in range(0, len(updates), batch_size):
+        batch = updates[i:i+batch_size]
+        for keys in set(tuple(sorted(u)) for u in batch):
+            session.execute(
+                update(table).where(table.c.id == bindparam('_id')),
+                [u for u in batch if tuple(sorted(u)) == keys]
+            )
+    for i in range(0, len(deletes), 500):
+        session.execute(table.delete().where(table.c.id.in_(deletes[i:i+500])))
+    if placed:
+        place_nested_sets(session, placed)
+    if counts['inserted'] or counts['updated'] or counts['moved'] or counts['deleted']:
+        bump_category_version(session)
     session.commit()
+    return counts
 
 
+# Filters are applied inside the recursive CTE wherever they can prune it:
+#   show_hidden=False  hidden categories are dropped in both the anchor and the
+#                      recursive member, so nothing below them is visited
+#   group              matches the root category's group, which every row of
+#                      its subtree inherits, so only those roots seed the CTE
+#   path               path prefix, e.g. '/Cat 1/Cat 1.'; recursion only follows
+#                      categories that lie on or below the prefix
+# name (exact), has_tag and tag (prefix) don't prune subtrees and are applied
+# to the CTE output.
+@instrumented('load_data', rows=len)
 def load_data(session, name=None, path=None, group=None, show_hidden=False, has_tag=None, tag=None):
-    if name is not None:
-        name = re.sub('_', '/_', name)
-    if path is not None:
-        path = re.sub('_', '/_', path)
-    if tag is not None:
-        tag = re.sub('_', '/_', tag)
-    tc_tree = \
-        session.query(
+    with stage('load_data.query') as stats:
+        categories = category_tree_query(session, name=name, path=path, group=group,
+                                         show_hidden=show_hidden, has_tag=has_tag, tag=tag).all()
+        stats.rows = len(categories)
+    with stage('load_data.build') as stats:
+        stats.rows = len(categories)
+        return [
+            TransactionCat(
+                id = row.id,
+                parent_id = row.parent_id,
+                name = row.name,
+                path = row.path,
+                type = row.type,
+                group = row.group,
+                description = row.description,
+                has_tag = row.has_tag,
+                tag = row.tag,
+                hidden = row.hidden)
+            for row in categories ]
+
+
+# load_data as a dict of column name -> list of values, without building a
+# TransactionCat per row. Feed to setup_tree_model_columns.
+@instrumented('load_columns', rows=lambda c: len(c['id']))
+def load_columns(session, **kwargs):
+    query = category_tree_query(session, **kwargs)
+    names = [c['name'] for c in query.column_descriptions]
+    rows = session.execute(query.statement).all()
+    if not rows:
+        return {name: [] for name in names}
+    return {name: list(values) for name, values in zip(names, zip(*rows))}
+
+
+def category_tree_query(session, name=None, path=None, group=None, show_hidden=False, has_tag=None, tag=None):
+    anchor = session.query(
             Category.id.label('id'),
             Category.name.label('name'),
             ('/' + Category.name).label('path'),
-            #literal('').label('path'),
             literal(0).label('level'),
             Category.parent_id.label('parent_id'),
             CategoryGroup.name.label('group'),
-            #literal(None).label('group'),
+            Category.type.label('type'),
             Category.description.label('description'),
             Category.has_tag.label('has_tag'),
             Category.tag.label('tag'),
             Category.hidden.label('hidden'),
         ) \
         .filter(Category.parent_id == None) \
-        .filter(CategoryGroup.id == Category.group_id) \
-        .cte(name='cat_tree', recursive=True)
+        .filter(CategoryGroup.id == Category.group_id)
+    if group is not None:
+        anchor = anchor.filter(CategoryGroup.name == group)
+    if show_hidden is False:
+        anchor = anchor.filter(Category.hidden.isnot(True))
+    if path is not None:
+        anchor = anchor.filter(on_path('/' + Category.name, path))
+    tc_tree = anchor.cte(name='cat_tree', recursive=True)
 
     tree_alias = aliased(tc_tree, name='tr')
     cat_alias = aliased(Category, name='tc')
 
-    tc_tree = tc_tree.union_all(
-        session.query(
+    member = session.query(
             cat_alias.id,
             cat_alias.name,
             (tree_alias.c.path + '/' + cat_alias.name),
             tree_alias.c.level + 1,
             tree_alias.c.id,
             tree_alias.c.group,
+            cat_alias.type,
             cat_alias.description,
             cat_alias.has_tag,
             cat_alias.tag,
             cat_alias.hidden
         ) \
         .filter(cat_alias.parent_id == tree_alias.c.id)
-    )
-    #tc_tree = session.query(tc_tree).filter(tc_tree.c.level > 0)
-    tc_tree = session.query(tc_tree)
-
-    return [
-        TransactionCat(
-            id = row.id,
-            parent_id = row.parent_id,
-            name = row.name,
-            path = row.path,
-            group = row.group,
-            description = row.description,
-            has_tag = row.has_tag,
-            tag = row.tag)
-        for row in tc_tree ]
-
-    #return tc_tree
-
-    categories = tc_tree.union_all(
-        session.query(
-            Category.id,
-            Category.name,
-            ('/' + Category.name),
-            literal(0).label('level'),
-            literal(None),
-            CategoryGroup.name,
-            Category.description,
-            Category.has_tag,
-            Category.tag,
-            Category.hidden
-        ) \
-        .filter(Category.parent_id == None) \
-        .filter(CategoryGroup.id == Category.group_id)
-    )
-    return categories
+    if show_hidden is False:
+        member = member.filter(cat_alias.hidden.isnot(True))
+    if path is not None:
+        member = member.filter(on_path(tree_alias.c.path + '/' + cat_alias.name, path))
+    tc_tree = tc_tree.union_all(member)
 
+    categories = session.query(tc_tree)
+    if path is not None:
+        categories = categories.filter(prefix_range(tc_tree.c.path, path))
     if name is not None:
-        #categories = categories.filter(Category.name.like(name+'%', escape='/'))
-        categories = categories.filter(Category.name == name)
-    #if path is not None:
-    #    categories = categories.filter(tc_alias.c.path.like(path+'%', escape='/'))
-    if group is not None:
-        categories = categories.filter(CategoryGroup.name == group)
-    if show_hidden is False:
-        categories = categories.filter(Category.hidden != True)
+        categories = categories.filter(tc_tree.c.name == name)
     if has_tag is not None:
-        categories = categories.filter(Category.has_tag == has_tag)
+        categories = categories.filter(tc_tree.c.has_tag == has_tag)
     if tag is not None:
-        categories = categories.filter(Category.tag.like(tag+'%', escape='/'))
-    results = categories.order_by(path)
-    print()
-    print()
-    print(results)
-    print()
+        categories = categories.filter(tc_tree.c.id.in_(
+            session.query(Category.id).filter(prefix_range(Category.tag, tag))))
+    return categories.order_by(tc_tree.c.path)
+
+
+# True when path_expr is an ancestor of, or lies at or below, the path prefix
+def on_path(path_expr, prefix):
+    return prefix_range(path_expr, prefix) \
+        | (func.substr(literal(prefix, String), 1, func.length(path_expr)) == path_expr)
+
+
+# Per-session cache of the small lookups the import and mutation functions
+# keep repeating: group name <-> id, category id -> row, path -> id and
+# name -> ids. Groups are loaded in one query the first time they're needed;
+# categories are fetched on a miss (misses are cached too) or all at once with
+# preload(). The mutation functions keep it up to date as they go, and it is
+# cleared when the session commits or rolls back. hits/misses count lookups
+# answered from the cache and lookups that had to query.
+class LookupCache:
+    def __init__(self, session):
+        self.session = session
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self._groups = None
+        self._group_names = None
+        self._rows = dict()
+        self._paths = dict()
+        self._names = dict()
+
+    def _load_groups(self):
+        if self._groups is None:
+            self.misses += 1
+            self._groups = dict(self.session.query(CategoryGroup.name, CategoryGroup.id))
+            self._group_names = {id: name for name, id in self._groups.items()}
+        else:
+            self.hits += 1
+
+    def groups(self):
+        self._load_groups()
+        return dict(self._groups)
+
+    def group_id(self, name):
+        self._load_groups()
+        return self._groups.get(name)
+
+    def group_name(self, id):
+        self._load_groups()
+        return self._group_names.get(id)
+
+    # id, parent_id, name, path and group_id of a category, or None
+    def category(self, id):
+        if id in self._rows:
+            self.hits += 1
+            return self._rows[id]
+        self.misses += 1
+        table = Category.__table__
+        row = self.session.execute(select(*self._columns()).where(table.c.id == id)).first()
+        self._rows[id] = None
+        if row is not None:
+            self.put(dict(row._mapping))
+        return self._rows[id]
+
+    def path_id(self, path):
+        if path in self._paths:
+            self.hits += 1
+            return self._paths[path]
+        self.misses += 1
+        table = Category.__table__
+        row = self.session.execute(select(*self._columns()).where(table.c.path == path)).first()
+        self._paths[path] = None
+        if row is not None:
+            self.put(dict(row._mapping))
+        return self._paths[path]
+
+    def name_ids(self, name):
+        if name in self._names:
+            self.hits += 1
+            return list(self._names[name])
+        self.misses += 1
+        table = Category.__table__
+        rows = self.session.execute(select(*self._columns()).where(table.c.name == name)).all()
+        self._names[name] = list()
+        for row in rows:
+            self.put(dict(row._mapping))
+        return list(self._names[name])
+
+    def preload(self):
+        self.misses += 1
+        for row in self.session.execute(select(*self._columns())):
+            self.put(dict(row._mapping))
+
+    def _columns(self):
+        table = Category.__table__
+        return [table.c.id, table.c.parent_id, table.c.name, table.c.path, table.c.group_id]
+
+    def put(self, row):
+        self.discard(row['id'])
+        self._rows[row['id']] = row
+        if row['path'] is not None:
+            self._paths[row['path']] = row['id']
+        if row['name'] in self._names:
+            self._names[row['name']].append(row['id'])
+
+    def discard(self, id):
+        row = self._rows.pop(id, None)
+        if row is not None:
+            if self._paths.get(row['path']) == id:
+                del self._paths[row['path']]
+            if id in self._names.get(row['name'], ()):
+                self._names[row['name']].remove(id)
 
+    # Drop a category that was added without a known id: forget anything
+    # cached as missing under its path or name
+    def added(self, name, path):
+        if self._paths.get(path, 0) is None:
+            del self._paths[path]
+        self._names.pop(name, None)
+
+    # Everything at or below path was deleted
+    def deleted(self, path):
+        for id, row in list(self._rows.items()):
+            if row is not None and (row['path'] == path or (row['path'] or '').startswith(path + '/')):
+                self.discard(id)
+        for p in [p for p in self._paths if p == path or p.startswith(path + '/')]:
+            del self._paths[p]
+
+    # Everything at or below old now lives below new
+    def moved(self, old, new):
+        for id, row in list(self._rows.items()):
+            if row is not None and row['path'] is not None \
+                    and (row['path'] == old or row['path'].startswith(old + '/')):
+                self.put(dict(row, path=new + row['path'][len(old):]))
+        for p in [p for p in self._paths if p == old or p.startswith(old + '/')]:
+            if self._paths[p] is None:
+                del self._paths[p]
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+
+def lookup_cache(session):
+    cache = session.info.get('lookup_cache')
+    if cache is None:
+        cache = session.info['lookup_cache'] = LookupCache(session)
+        event.listen(session, 'after_commit', lambda s: cache.clear())
+        event.listen(session, 'after_rollback', lambda s: cache.clear())
+    return cache
+
+
+def bump_category_version(session):
+    table = CategoryVersion.__table__
+    result = session.execute(update(table).where(table.c.id == 1).values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        session.execute(insert(table).values(id=1, instance=uuid.uuid4().hex, version=1))
+
+
+# 'instance:version', or None for a database without a version row
+def category_version(session):
+    table = CategoryVersion.__table__
+    row = session.execute(select(table.c.instance, table.c.version).where(table.c.id == 1)).first()
+    return f"{row.instance}:{row.version}" if row is not None else None
 
 
 # TODO: New category inherits everythin from parents
@@ -429,21 +2283,38 @@ def add_new_category(session, name=None, parent_name=None, type=None, group_name
                         description=None, has_tag=None, tag=None, hidden=None):
 
     parent = None
+    cache = lookup_cache(session)
 
-    # TODO: error if parent category doesn't exist
     if parent_name is not None:
-        parent = session.query(Category) \
-                .filter(Category.name == parent_name).one()
-    group = session.query(CategoryGroup) \
-            .filter(CategoryGroup.name == group_name).one()
+        ids = cache.name_ids(parent_name)
+        if not ids:
+            raise sqlalchemy.exc.NoResultFound(f"No category named {parent_name}")
+        if len(ids) > 1:
+            raise sqlalchemy.exc.MultipleResultsFound(f"Multiple categories named {parent_name}")
+        parent = session.get(Category, ids[0])
+    group_id = cache.group_id(group_name)
+    if group_id is None:
+        raise sqlalchemy.exc.NoResultFound(f"No group named {group_name}")
 
-    tc = Category(name, parent=parent, type=type, group_id=group.id, description=description,
+    gap = nested_set_gap(session, parent.id if parent is not None else None)
+    numbers = nested_set_numbers(*gap, 2) if gap is not None else None
+
+    tc = Category(name, parent=parent, type=type, group_id=group_id, description=description,
             has_tag=has_tag, tag=tag, hidden=hidden)
+    if numbers is not None:
+        tc.lft, tc.rgt = numbers
     session.add(tc)
+    cache.added(tc.name, tc.path)
+    if numbers is None:
+        renumber_categories(session)
+    bump_category_version(session)
 
 
 def modify_category(session, **kwargs):
-    tc = session.query(Category).filter(Category.id == kwargs['id']).one()
+    tc = session.get(Category, kwargs['id'])
+    if tc is None:
+        raise sqlalchemy.exc.NoResultFound(f"No category with id {kwargs['id']}")
+    old_parent_id = tc.parent_id
 
     if 'name' in kwargs:
         tc.name = kwargs['name']
@@ -459,17 +2330,982 @@ def modify_category(session, **kwargs):
         tc.tag = kwargs['tag']
     if 'hidden' in kwargs:
         tc.hidden = kwargs['hidden']
+    if 'name' in kwargs or 'parent_id' in kwargs:
+        update_category_path(session, tc)
+    if tc.parent_id != old_parent_id:
+        move_nested_set(session, tc)
+    lookup_cache(session).put(dict(id=tc.id, parent_id=tc.parent_id, name=tc.name,
+                                   path=tc.path, group_id=tc.group_id))
+    bump_category_version(session)
 
     print(tc.description)
 
 
+# Recompute tc.path after a rename or re-parent and rewrite the paths of
+# everything below it in a single UPDATE.
+def update_category_path(session, tc):
+    cache = lookup_cache(session)
+    parent_path = None
+    if tc.parent_id is not None:
+        parent = cache.category(tc.parent_id)
+        parent_path = parent['path'] if parent is not None else None
+
+    old = tc.path
+    new = category_path(parent_path, tc.name)
+    if old == new:
+        return
+    if old is not None and parent_path is not None \
+            and (parent_path == old or parent_path.startswith(old + '/')):
+        raise ValueError(f"Cannot move {old} below itself")
+
+    if old is not None:
+        session.query(Category) \
+            .filter(subtree_range(Category.path, old)) \
+            .update({Category.path: literal(new, String) + func.substr(Category.path, len(old) + 1)},
+                    synchronize_session='fetch')
+        cache.moved(old, new)
+    tc.path = new
+
+
+# Renumbers lft and rgt for every category, siblings in path order, with gap
+# between consecutive numbers. Only rows whose numbers change are written;
+# returns how many were. bind is a session or a connection.
+@instrumented('renumber_categories', rows=lambda n: n)
+def renumber_categories(bind, gap=NESTED_SET_GAP):
+    table = Category.__table__
+    rows = bind.execute(select(table.c.id, table.c.parent_id, table.c.lft, table.c.rgt)
+                        .order_by(table.c.path)).all()
+    if not rows:
+        return 0
+    ids, parent_ids, lfts, rgts = zip(*rows)
+    parent, first_child, next_sibling, _ = link_columns(ids, parent_ids)
+    lft, rgt = euler_numbers(parent, first_child, next_sibling, gap)
+    changed = [dict(_id=id, _lft=lft[i], _rgt=rgt[i]) for i, id in enumerate(ids, 1)
+               if lft[i] != lfts[i-1] or rgt[i] != rgts[i-1]]
+    stmt = update(table) \
+        .where(table.c.id == bindparam('_id')) \
+        .values(lft=bindparam('_lft'), rgt=bindparam('_rgt'))
+    for batch in chunks(changed, 5000):
+        bind.execute(stmt, batch)
+    return len(changed)
+
+
+# The free numbers (lo, hi) after the last child of parent_id, leaving out
+# category exclude. hi is None at the top level, which has no upper bound.
+# None if the parent has no numbers.
+def nested_set_gap(session, parent_id, exclude=None):
+    table = Category.__table__
+    last = select(func.max(table.c.rgt)).where(table.c.parent_id == parent_id)
+    if exclude is not None:
+        last = last.where(table.c.id != exclude)
+    lo, hi = 0, None
+    if parent_id is not None:
+        parent = session.execute(select(table.c.lft, table.c.rgt).where(table.c.id == parent_id)).first()
+        if parent is None or parent.lft is None:
+            return None
+        lo, hi = parent
+    last = session.execute(last).scalar()
+    return max(lo, last) if last is not None else lo, hi
+
+
+# count numbers strictly between lo and hi, spread out so there is room for
+# later additions on either side, or None if they don't fit
+def nested_set_numbers(lo, hi, count, gap=NESTED_SET_GAP):
+    step = gap if hi is None else min(gap, (hi - lo) // (count + 1))
+    if step < 1:
+        return None
+    return [lo + step * (k + 1) for k in range(count)]
+
+
+# Numbers category tc and everything below it after a move, in the gap after
+# the last child of its new parent and in the same order as before. Falls back
+# to renumbering the whole table if the gap is too small.
+def move_nested_set(session, tc):
+    table = Category.__table__
+    top = session.execute(select(table.c.lft, table.c.rgt).where(table.c.id == tc.id)).first()
+    gap = nested_set_gap(session, tc.parent_id, exclude=tc.id)
+    if top is None or top.lft is None or gap is None:
+        return renumber_categories(session)
+
+    rows = session.execute(select(table.c.id, table.c.lft, table.c.rgt)
+                           .where(nested_set_range(table.c.lft, top.lft, top.rgt, include_self=True))).all()
+    old = sorted(n for row in rows for n in (row.lft, row.rgt))
+    numbers = nested_set_numbers(*gap, len(old))
+    if numbers is None:
+        return renumber_categories(session)
+    new = dict(zip(old, numbers))
+    stmt = update(table) \
+        .where(table.c.id == bindparam('_id')) \
+        .values(lft=bindparam('_lft'), rgt=bindparam('_rgt'))
+    session.execute(stmt, [dict(_id=row.id, _lft=new[row.lft], _rgt=new[row.rgt]) for row in rows])
+    return len(rows)
+
+
+# Most categories place_nested_sets fits in one at a time before it
+# renumbers the whole table instead
+NESTED_SET_PLACE_LIMIT = 1000
+
+
+# Numbers the categories ids (new ones, or ones given another parent) and
+# everything below them after a bulk change, without renumbering the table.
+# Each goes in the gap after the last child of its parent, shallowest first,
+# with its subtree numbered in path order as renumber_categories would.
+# Categories already numbered as part of an earlier one's subtree are
+# skipped. Falls back to renumbering the whole table if a gap is too small, a
+# parent has no numbers, or there are more than NESTED_SET_PLACE_LIMIT ids.
+# Returns how many rows were written.
+def place_nested_sets(session, ids, gap=NESTED_SET_GAP):
+    table = Category.__table__
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > NESTED_SET_PLACE_LIMIT:
+        return renumber_categories(session, gap)
+    tops = list()
+    for chunk in chunks(ids, 500):
+        tops.extend(session.execute(select(table.c.id, table.c.parent_id, table.c.path)
+                                    .where(table.c.id.in_(chunk))))
+    if any(top.path is None for top in tops):
+        return renumber_categories(session, gap)
+    tops.sort(key=lambda top: top.path.count('/'))
+
+    stmt = update(table) \
+        .where(table.c.id == bindparam('_id')) \
+        .values(lft=bindparam('_lft'), rgt=bindparam('_rgt'))
+    done = set()
+    written = 0
+    for top in tops:
+        if top.id in done:
+            continue
+        rows = session.execute(select(table.c.id, table.c.parent_id)
+                               .where(subtree_range(table.c.path, top.path))
+                               .order_by(table.c.path)).all()
+        children = dict()
+        for row in rows:
+            children.setdefault(row.parent_id, list()).append(row.id)
+
+        # depth first from top, one entry on the way in and out of each
+        order = list()
+        stack = [(top.id, False)]
+        while stack:
+            id, out = stack.pop()
+            order.append(id)
+            if not out:
+                stack.append((id, True))
+                stack.extend((child, False) for child in reversed(children.get(id, [])))
+
+        span = nested_set_gap(session, top.parent_id, exclude=top.id)
+        numbers = nested_set_numbers(*span, len(order), gap) if span is not None else None
+        if numbers is None:
+            return renumber_categories(session, gap)
+        lft = dict()
+        values = list()
+        for id, number in zip(order, numbers):
+            if id in lft:
+                values.append(dict(_id=id, _lft=lft[id], _rgt=number))
+            else:
+                lft[id] = number
+        session.execute(stmt, values)
+        done.update(lft)
+        written += len(values)
+    return written
+
+
+# Deletes the matching categories and everything below them, the same as the
+# delete-orphan cascade on Category.children would.
 def delete_category(session, **kwargs):
     print(kwargs)
+    paths = [p for (p,) in session.query(Category.path).filter_by(**kwargs) if p is not None]
+    for path in paths:
+        session.query(Category) \
+            .filter(subtree_range(Category.path, path)) \
+            .delete(synchronize_session='fetch')
+        lookup_cache(session).deleted(path)
     tc = session.query(Category).filter_by(**kwargs).delete()
+    bump_category_version(session)
+
+
+# Apply many category changes in one transaction. Each operation is a dict
+# with an 'op' key and the same arguments as the single-category functions:
+#
+#   {'op': 'add', 'name': ..., 'parent_name': ... (or 'parent_id'), 'type': ...,
+#    'group_name': ..., 'description': ..., 'has_tag': ..., 'tag': ..., 'hidden': ...}
+#   {'op': 'modify', 'id': ..., 'name': ..., 'type': ..., ...}
+#   {'op': 'move', 'id': ..., 'parent_id': ...}      (None for top level)
+#   {'op': 'delete', 'id': ...}                      (and everything below it)
+#
+# Parent names and referenced ids are each resolved with one IN query up
+# front and groups come from the lookup cache. The changes are written with
+# executemany, batching consecutive statements of the same kind so operations
+# still apply in order.
+# Adds and moves are fitted into the nested set at the end by
+# place_nested_sets. Operations that fail validation are skipped; the rest are
+# committed. Returns one {'op', 'id', 'error'} dict per operation.
+def apply_category_changes(session, operations, batch_size=5000):
+    table = Category.__table__
+    operations = list(operations)
+
+    parent_names = set(op['parent_name'] for op in operations
+                       if op.get('op') == 'add' and op.get('parent_name') is not None)
+    ids = set()
+    for op in operations:
+        for k in ('id', 'parent_id'):
+            if op.get(k) is not None:
+                ids.add(op[k])
+
+    # name -> [rows], id -> row, group name -> id
+    by_name = dict()
+    rows = dict()
+    columns = [table.c.id, table.c.parent_id, table.c.name, table.c.path]
+    for names in chunks(list(parent_names), 500):
+        for r in session.execute(select(*columns).where(table.c.name.in_(names))):
+            row = dict(r._mapping)
+            rows.setdefault(row['id'], row)
+            by_name.setdefault(row['name'], list()).append(rows[row['id']])
+    for id_chunk in chunks(list(ids - set(rows)), 500):
+        for r in session.execute(select(*columns).where(table.c.id.in_(id_chunk))):
+            rows[r.id] = dict(r._mapping)
+    groups = lookup_cache(session).groups()
+
+    next_id = (session.query(func.max(Category.id)).scalar() or 0) + 1
+    writer = BatchWriter(session, batch_size)
+    results = list()
+    placed = list()     # ids added or given another parent, for place_nested_sets
+
+    # Rewrite the path of every cached row at or below old, as the repath
+    # statement will in the database
+    def repath(old, new):
+        for row in rows.values():
+            p = row['path']
+            if p is not None and (p == old or p.startswith(old + '/')):
+                row['path'] = new + p[len(old):]
+        writer.add('repath', update(table)
+                   .where((table.c.path >= bindparam('_lo')) & (table.c.path < bindparam('_hi')))
+                   .values(path=bindparam('_new', type_=String) + func.substr(table.c.path, bindparam('_cut'))),
+                   dict(_lo=old + '/', _hi=old + '0', _new=new, _cut=len(old) + 1))
+
+    for op in operations:
+        kind = op.get('op')
+        result = dict(op=kind, id=op.get('id'), error=None)
+        results.append(result)
+        try:
+            if kind == 'add':
+                for k in ('name', 'type'):
+                    if not op.get(k):
+                        raise ValueError(f"Missing {k}")
+                parent = None
+                if op.get('parent_name') is not None:
+                    found = by_name.get(op['parent_name'], [])
+                    if len(found) != 1:
+                        raise ValueError(f"{len(found) or 'No'} categories named {op['parent_name']}")
+                    parent = found[0]
+                elif op.get('parent_id') is not None:
+                    parent = rows.get(op['parent_id'])
+                    if parent is None:
+                        raise ValueError(f"Category not found: {op['parent_id']}")
+                if op.get('group_name') not in groups:
+                    raise ValueError(f"Group not found: {op.get('group_name')}")
+                row = dict(
+                    id = next_id,
+                    parent_id = parent['id'] if parent else None,
+                    name = op.get('name'),
+                    path = category_path(parent['path'] if parent else None, op.get('name')),
+                    type = op.get('type'),
+                    description = op.get('description'),
+                    group_id = groups[op['group_name']],
+                    has_tag = op.get('has_tag', False),
+                    tag = op.get('tag'),
+                    hidden = op.get('hidden', False))
+                next_id += 1
+                placed.append(row['id'])
+                writer.add('insert', insert(table), row)
+                rows[row['id']] = dict((k, row[k]) for k in ('id', 'parent_id', 'name', 'path'))
+                by_name.setdefault(row['name'], list()).append(rows[row['id']])
+                result['id'] = row['id']
+
+            elif kind in ('modify', 'move'):
+                row = rows.get(op.get('id'))
+                if row is None:
+                    raise ValueError(f"Category not found: {op.get('id')}")
+                fields = ['parent_id'] if kind == 'move' else \
+                    ['name', 'parent_id', 'type', 'description', 'has_tag', 'tag', 'hidden']
+                values = {k: op[k] for k in fields if k in op}
+                for k in ('name', 'type'):
+                    if k in values and not values[k]:
+                        raise ValueError(f"Missing {k}")
+                if 'group_name' in op and kind == 'modify':
+                    if op['group_name'] not in groups:
+                        raise ValueError(f"Group not found: {op['group_name']}")
+                    values['group_id'] = groups[op['group_name']]
+
+                if 'name' in values or 'parent_id' in values:
+                    parent_id = values.get('parent_id', row['parent_id'])
+                    parent = rows.get(parent_id) if parent_id is not None else None
+                    if parent_id is not None and parent is None:
+                        raise ValueError(f"Category not found: {parent_id}")
+                    old = row['path']
+                    new = category_path(parent['path'] if parent else None, values.get('name', row['name']))
+                    if old is not None and parent is not None \
+                            and (parent['path'] == old or parent['path'].startswith(old + '/')):
+                        raise ValueError(f"Cannot move {old} below itself")
+                    if old is not None and old != new:
+                        repath(old, new)
+                    row['path'] = values['path'] = new
+                    if parent_id != row['parent_id']:
+                        placed.append(row['id'])
+                row.update((k, v) for k, v in values.items() if k in row)
+                if values:
+                    writer.add(('update',) + tuple(sorted(values)),
+                               update(table).where(table.c.id == bindparam('_id')),
+                               dict(values, _id=row['id']))
+
+            elif kind == 'delete':
+                row = rows.get(op.get('id'))
+                if row is None:
+                    raise ValueError(f"Category not found: {op.get('id')}")
+                path = row['path']
+                for id in [id for id, r in rows.items()
+                           if id == row['id'] or (path is not None and (r['path'] or '').startswith(path + '/'))]:
+                    r = rows.pop(id)
+                    if r in by_name.get(r['name'], []):
+                        by_name[r['name']].remove(r)
+                if path is not None:
+                    writer.add('delete_subtree', table.delete()
+                               .where((table.c.path >= bindparam('_lo')) & (table.c.path < bindparam('_hi'))),
+                               dict(_lo=path + '/', _hi=path + '0'))
+                writer.add('delete', table.delete().where(table.c.id == bindparam('_id')), dict(_id=row['id']))
+
+            else:
+                raise ValueError(f"Unknown operation: {kind}")
+        except ValueError as err:
+            result['error'] = str(err)
+
+    try:
+        writer.flush()
+        if any(r['op'] == 'add' and r['error'] is None for r in results):
+            advance_category_sequence(session)
+        if placed:
+            place_nested_sets(session, placed)
+        if any(r['error'] is None for r in results):
+            bump_category_version(session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return results
+
+
+# Collects statement parameters and runs them with executemany, one batch
+# per run of consecutive statements of the same kind
+class BatchWriter:
+    def __init__(self, session, batch_size=5000):
+        self.session = session
+        self.batch_size = batch_size
+        self.kind = None
+        self.stmt = None
+        self.params = list()
+
+    def add(self, kind, stmt, params):
+        if kind != self.kind or len(self.params) >= self.batch_size:
+            self.flush()
+            self.kind = kind
+            self.stmt = stmt
+        self.params.append(params)
+
+    def flush(self):
+        if self.params:
+            self.session.execute(self.stmt, self.params)
+        self.kind = None
+        self.stmt = None
+        self.params = list()
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+# Rules as dicts with their category's id, path and level, for RuleMatcher
+def load_rules(session):
+    rule = CategoryRule.__table__
+    cat = Category.__table__
+    rows = session.execute(
+        select(rule.c.id, rule.c.category_id, rule.c.payee, rule.c.min_amount,
+               rule.c.max_amount, rule.c.tag, cat.c.path)
+        .where(cat.c.id == rule.c.category_id)
+        .order_by(rule.c.id))
+    return [dict(r._mapping, level=(r.path or '').count('/')) for r in rows]
+
+
+# Longest run of plain characters that every match of a regex has to
+# contain, lowercased. Only the top level of the pattern is looked at;
+# anything with alternation gives ''.
+def required_literal(pattern):
+    if '|' in pattern:
+        return ''
+    runs = ['']
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            i += 1
+            e = pattern[i]
+            if e.isalnum():
+                # a class, anchor, character code or backreference: skip
+                # its arguments too
+                if e in 'xuU':
+                    i += dict(x=2, u=4, U=8)[e]
+                elif e == 'N' and pattern.startswith('{', i + 1):
+                    i = pattern.find('}', i)
+                    if i < 0:
+                        break
+                elif e.isdigit():
+                    end = i + 3 if e == '0' or pattern[i+1:i+3].isdigit() else i + 2
+                    while i + 1 < min(end, len(pattern)) and pattern[i + 1].isdigit():
+                        i += 1
+                runs.append('')
+            else:
+                runs[-1] += e
+        elif c in '([':
+            # skip the group or class
+            close = ')' if c == '(' else ']'
+            depth = 0
+            while i < len(pattern):
+                if pattern[i] == '\\':
+                    i += 1
+                elif pattern[i] == c:
+                    depth += 1
+                elif pattern[i] == close:
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            runs.append('')
+        elif c in '*?{':
+            # the character before is optional
+            runs[-1] = runs[-1][:-1]
+            runs.append('')
+            if c == '{':
+                i = pattern.find('}', i)
+                if i < 0:
+                    break
+        elif c in '.^$+)]}':
+            runs.append('')
+        else:
+            runs[-1] += c
+        i += 1
+    return max(runs, key=len).lower()
+
+
+# A set of categorization rules combined into one matcher. Rules are ordered
+# most specific first: deepest category, then most conditions, then the
+# order given, and match() returns the first one that holds. Rather than
+# trying every rule's regex, each rule is indexed by one trigram of a
+# literal its payee pattern must contain (see required_literal), the one
+# fewest other rules' literals share. Only rules whose trigram occurs in the
+# text, plus the few that have no such literal, are tried.
+# rules are dicts (see load_rules) with category_id and any of payee,
+# min_amount, max_amount, tag and level (0 if missing).
+class RuleMatcher:
+    def __init__(self, rules):
+        rules = [dict(r) for r in rules]
+        conditions = lambda r: sum(r.get(k) is not None for k in ('payee', 'min_amount', 'max_amount', 'tag'))
+        order = sorted(range(len(rules)), key=lambda i: (-(rules[i].get('level') or 0), -conditions(rules[i]), i))
+        self.rules = [rules[i] for i in order]
+        self.regexes = [re.compile(r['payee'], re.IGNORECASE) if r.get('payee') else None
+                        for r in self.rules]
+        literals = [required_literal(r['payee']) if r.get('payee') else '' for r in self.rules]
+        grams = [trigrams(literal, pad=False) for literal in literals]
+        counts = collections.Counter(g for gs in grams for g in gs)
+        self.index = dict()
+        self.always = list()
+        for i, gs in enumerate(grams):
+            if gs:
+                self.index.setdefault(min(gs, key=lambda g: (counts[g], g)), list()).append(i)
+            else:
+                self.always.append(i)
+
+    def __len__(self):
+        return len(self.rules)
+
+    # The most specific rule matching text, amount and tag, or None
+    def match(self, text, amount=None, tag=None):
+        text = text or ''
+        lowered = text.lower()
+        candidates = set(self.always)
+        for i in range(len(lowered) - 2):
+            found = self.index.get(lowered[i:i+3])
+            if found:
+                candidates.update(found)
+        for i in sorted(candidates):
+            rule = self.rules[i]
+            regex = self.regexes[i]
+            if (regex is None or regex.search(text)) \
+                    and (rule.get('min_amount') is None or (amount is not None and amount >= rule['min_amount'])) \
+                    and (rule.get('max_amount') is None or (amount is not None and amount <= rule['max_amount'])) \
+                    and (rule.get('tag') is None or rule['tag'] == tag):
+                return rule
+        return None
+
+
+# "1,234.56", "-12.3" or "(12.30)" -> cents
+def parse_amount(text):
+    text = text.strip().replace(',', '')
+    negative = text.startswith('(') and text.endswith(')')
+    cents = int((decimal.Decimal(text.strip('()')) * 100).to_integral_value(decimal.ROUND_HALF_UP))
+    return -cents if negative else cents
+
+
+# Transactions from a CSV with a header row naming (any case) some of
+# date, account, payee, description, amount and tag. Rows without a usable
+# amount are reported and skipped.
+def iter_transactions_csv(file):
+    columns = ['account', 'date', 'payee', 'description', 'tag']
+    for line, row in enumerate(iter_csv(file), 2):
+        row = {(k or '').strip().lower(): (v.strip() if isinstance(v, str) else v) for k, v in row.items()}
+        try:
+            amount = parse_amount(row.get('amount') or '')
+        except decimal.InvalidOperation:
+            print(f"Skipping transaction on line {line}: bad amount {row.get('amount')!r}")
+            continue
+        tx = {c: row.get(c) or None for c in columns}
+        tx['amount'] = amount
+        yield tx
+
+
+# Categorizes a stream of transactions (dicts as from iter_transactions_csv,
+# or a CSV file name) in one pass and writes them in batches of batch_size
+# with executemany. Transactions with an 'id' already stored get their
+# category_id updated; the rest are inserted. rules defaults to every
+# CategoryRule in the database. Returns counts of transactions, matched,
+# inserted and updated, plus the seconds taken and transactions per second.
+@instrumented('categorize_transactions', rows=lambda stats: stats['transactions'])
+def categorize_transactions(session, transactions, rules=None, batch_size=5000):
+    start = time.perf_counter()
+    table = Transaction.__table__
+    matcher = rules if isinstance(rules, RuleMatcher) else RuleMatcher(load_rules(session) if rules is None else rules)
+    if isinstance(transactions, str):
+        transactions = iter_transactions_csv(transactions)
+
+    columns = ['account', 'date', 'payee', 'description', 'amount', 'tag', 'category_id']
+    insert_stmt = insert(table)
+    update_stmt = update(table).where(table.c.id == bindparam('_id')).values(category_id=bindparam('_category_id'))
+    stats = dict(transactions=0, matched=0, inserted=0, updated=0)
+    inserts = list()
+    updates = list()
+
+    def flush():
+        with stage('categorize_transactions.write'):
+            if inserts:
+                session.execute(insert_stmt, inserts)
+                stats['inserted'] += len(inserts)
+            if updates:
+                session.execute(update_stmt, updates)
+                stats['updated'] += len(updates)
+        inserts.clear()
+        updates.clear()
+
+    for tx in transactions:
+        rule = matcher.match(tx.get('payee') or tx.get('description'), tx.get('amount'), tx.get('tag'))
+        category_id = rule['category_id'] if rule is not None else None
+        stats['transactions'] += 1
+        stats['matched'] += rule is not None
+        if tx.get('id') is not None:
+            updates.append(dict(_id=tx['id'], _category_id=category_id))
+        else:
+            row = {c: tx.get(c) for c in columns}
+            row['category_id'] = category_id
+            inserts.append(row)
+        if len(inserts) + len(updates) >= batch_size:
+            flush()
+    flush()
+    session.commit()
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['per_second'] = stats['transactions'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+# Re-runs the rules over stored transactions (all of them, or only those
+# without a category). They are read in id order, batch_size at a time, so
+# the table is never held in memory.
+def recategorize_transactions(session, rules=None, uncategorized=False, batch_size=5000):
+    table = Transaction.__table__
+
+    def stored():
+        last = None
+        while True:
+            query = select(table.c.id, table.c.payee, table.c.description, table.c.amount, table.c.tag) \
+                .order_by(table.c.id).limit(batch_size)
+            if uncategorized:
+                query = query.where(table.c.category_id == None)
+            if last is not None:
+                query = query.where(table.c.id > last)
+            rows = session.execute(query).all()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row._mapping)
+            last = rows[-1].id
+
+    return categorize_transactions(session, stored(), rules, batch_size)
+
+
+# Transaction count and amount (cents) per category id, as values for
+# setup_tree_model. With by='type' or 'group' each category also gets
+# ('count', <its type or group>) and ('amount', ...) entries, so the totals
+# further up the tree are split by type or group as well.
+def transaction_totals(session, by=None):
+    tx = Transaction.__table__
+    cat = Category.__table__
+    columns = [tx.c.category_id, func.count().label('count'), func.sum(tx.c.amount).label('amount')]
+    query = select(*columns).where(tx.c.category_id != None).group_by(tx.c.category_id)
+    if by == 'type':
+        query = query.add_columns(cat.c.type.label('split')) \
+            .where(cat.c.id == tx.c.category_id).group_by(cat.c.type)
+    elif by == 'group':
+        grp = CategoryGroup.__table__
+        query = query.add_columns(grp.c.name.label('split')) \
+            .where(cat.c.id == tx.c.category_id).where(grp.c.id == cat.c.group_id).group_by(grp.c.name)
+    elif by is not None:
+        raise ValueError("by must be None, 'type' or 'group'")
+
+    totals = dict()
+    for row in session.execute(query):
+        values = dict(count=row.count, amount=row.amount or 0)
+        if by is not None:
+            values[('count', row.split)] = row.count
+            values[('amount', row.split)] = row.amount or 0
+        totals[row.category_id] = values
+    return totals
+
+
+# Everything below category id, in path order
+def load_subtree(session, id, include_self=False):
+    top = aliased(Category, name='top')
+    cond = nested_set_range(Category.lft, top.lft, top.rgt, include_self)
+    return session.query(Category) \
+        .join(top, cond) \
+        .filter(top.id == id) \
+        .order_by(Category.path) \
+        .all()
+
+
+# True if category id is somewhere below category ancestor_id
+def is_below(session, id, ancestor_id):
+    table = Category.__table__
+    rows = {row.id: row for row in session.execute(select(table.c.id, table.c.lft, table.c.rgt)
+                                                   .where(table.c.id.in_([id, ancestor_id])))}
+    if id == ancestor_id or id not in rows or ancestor_id not in rows:
+        return False
+    top, row = rows[ancestor_id], rows[id]
+    return top.lft < row.lft and row.rgt < top.rgt
+
+
+# Every category above category id, root first
+def load_ancestors(session, id):
+    path = session.query(Category.path).filter(Category.id == id).scalar()
+    if path is None:
+        return []
+    parts = path.split('/')[1:-1]
+    paths = ['/' + '/'.join(parts[:i]) for i in range(1, len(parts)+1)]
+    return session.query(Category) \
+        .filter(Category.path.in_(paths)) \
+        .order_by(Category.path) \
+        .all()
+
+
+# Every category whose full path starts with prefix, e.g. '/Cat 1/Cat 1.'
+def load_path_prefix(session, prefix):
+    return session.query(Category) \
+        .filter(prefix_range(Category.path, prefix)) \
+        .order_by(Category.path) \
+        .all()
+
+
+# Migration for databases created before Category.path existed: adds the
+# column and any missing indexes, then backfills every row from the
+# parent_id links. bind is an engine or a connection.
+def migrate_category_path(bind):
+    if isinstance(bind, Engine):
+        with bind.begin() as conn:
+            return migrate_category_path(conn)
+
+    conn = bind
+    table = Category.__table__
+    insp = inspect(conn)
+    columns = [c['name'] for c in insp.get_columns(table.name)]
+    indexes = [i['name'] for i in insp.get_indexes(table.name)]
+
+    if 'path' not in columns:
+        path_type = table.c.path.type.compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN path {path_type}"))
+    for index in table.indexes:
+        if index.name not in indexes:
+            index.create(conn)
+
+    tree = select(table.c.id, ('/' + table.c.name).label('path')) \
+        .where(table.c.parent_id == None) \
+        .cte(name='cat_path', recursive=True)
+    tree_alias = tree.alias('tr')
+    cat_alias = table.alias('tc')
+    tree = tree.union_all(
+        select(cat_alias.c.id, tree_alias.c.path + '/' + cat_alias.c.name)
+        .where(cat_alias.c.parent_id == tree_alias.c.id)
+    )
+
+    stmt = update(table) \
+        .where(table.c.id == bindparam('_id')) \
+        .values(path=bindparam('_path'))
+    rows = conn.execute(select(tree.c.id, tree.c.path)).all()
+    if rows:
+        conn.execute(stmt, [{'_id': id, '_path': path} for id, path in rows])
+
+
+# Migration for databases created before Category.lft/rgt existed: adds the
+# columns and the lft index. The rows are numbered by renumber_categories
+# once the path migration has run. bind is a connection.
+def migrate_nested_set(bind):
+    table = Category.__table__
+    indexes = [i['name'] for i in inspect(bind).get_indexes(table.name)]
+    bind.execute(text(f"ALTER TABLE {table.name} ADD COLUMN lft BIGINT"))
+    bind.execute(text(f"ALTER TABLE {table.name} ADD COLUMN rgt BIGINT"))
+    for index in table.indexes:
+        if 'lft' in index.columns and index.name not in indexes:
+            index.create(bind)
+
+
+# Engine for a sqlite or PostgreSQL URL (see Category.path and
+# advance_category_sequence for other databases), defaulting to an in-memory
+# sqlite database.
+# File-backed sqlite databases get a real connection pool and are tuned on
+# connect for many concurrent readers and one writer: WAL journal,
+# synchronous=NORMAL, memory-mapped I/O (mmap_size bytes) and a page cache of
+# cache_size KiB. Tables are created if missing and older databases get the
+# path and nested set migrations.
+def open_category_db(url=None, echo=False, pool_size=5, mmap_size=256*1024*1024, cache_size=64*1024):
+    url = make_url(url or "sqlite://")
+    kwargs = dict(echo=echo)
+    file_sqlite = url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+    if file_sqlite:
+        kwargs.update(
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=pool_size,
+            connect_args={'check_same_thread': False, 'timeout': 30},
+        )
+    elif url.get_backend_name() != 'sqlite':
+        kwargs.update(pool_size=pool_size, pool_pre_ping=True)
+    engine = create_engine(url, **kwargs)
+
+    if file_sqlite:
+        tune_sqlite(engine, mmap_size, cache_size)
+    create_category_tables(engine)
+    return engine
+
+
+def tune_sqlite(engine, mmap_size, cache_size):
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        cursor.execute(f"PRAGMA cache_size=-{int(cache_size)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+
+# Creates missing tables, migrates older databases and adds the version row.
+# bind is an engine or a connection.
+def create_category_tables(bind):
+    if isinstance(bind, Engine):
+        with bind.begin() as conn:
+            return create_category_tables(conn)
+
+    tables = [Base.metadata.tables['category'],
+              Base.metadata.tables['category_group'],
+              Base.metadata.tables['category_version'],
+              Base.metadata.tables['bank_transaction'],
+              Base.metadata.tables['category_rule']]
+    exists = inspect(bind).has_table('category')
+    Base.metadata.create_all(bind, tables=tables)
+    columns = [c['name'] for c in inspect(bind).get_columns('category')] if exists else []
+    if exists and 'lft' not in columns:
+        migrate_nested_set(bind)
+    if exists and 'path' not in columns:
+        migrate_category_path(bind)
+    if exists and 'lft' not in columns:
+        renumber_categories(bind)
+    version = CategoryVersion.__table__
+    if bind.execute(select(version.c.id)).first() is None:
+        bind.execute(insert(version).values(id=1, instance=uuid.uuid4().hex, version=0))
+
+
+# Shared category database for one process. Any number of threads can read
+# through their own reader() sessions while writes are serialised through
+# writer(), which commits on success and rolls back on error:
+#
+#   store = CategoryStore("sqlite:///categories.db")
+#   with store.reader() as session:
+#       data = load_data(session)
+#   with store.writer() as session:
+#       add_new_category(session, name='new cat', type='Type B', group_name='Group C')
+#
+# An in-memory database is private to one connection, so sharing it between
+# threads needs a file or server database.
+class CategoryStore:
+    def __init__(self, url=None, **kwargs):
+        self.engine = open_category_db(url, **kwargs)
+        self.Session = sessionmaker(bind=self.engine)
+        self._write_lock = threading.Lock()
+
+    def reader(self):
+        return self.Session()
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            session = self.Session()
+            try:
+                yield session
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+
+# Asyncio front end to the same operations, for use inside an event loop.
+# Each call runs the functions above on its own AsyncSession through
+# run_sync, so the database I/O awaits instead of blocking the loop, and
+# independent calls can be gathered. Writes are serialised through an
+# asyncio.Lock, commit on success and roll back on error. Tree building and
+# searching are CPU bound and run in an executor (the default thread pool
+# unless one is given). Needs the asyncio extension (greenlet) and an async
+# driver; plain sqlite URLs are switched to aiosqlite.
+#
+#   store = AsyncCategoryStore("sqlite:///categories.db")
+#   await store.open()
+#   groups, data = await store.load(group='Group A')
+#   tree = await store.setup_tree_model(data)
+#   await store.add_new_category(name='new cat', type='Type B', group_name='Group C')
+#
+# As with CategoryStore, concurrent calls need a file or server database.
+class AsyncCategoryStore:
+    def __init__(self, url=None, executor=None, echo=False, mmap_size=256*1024*1024, cache_size=64*1024):
+        if create_async_engine is None:
+            raise ImportError("AsyncCategoryStore needs sqlalchemy.ext.asyncio")
+        url = make_url(url or "sqlite://")
+        if url.drivername == 'sqlite':
+            url = url.set(drivername='sqlite+aiosqlite')
+        self.engine = create_async_engine(url, echo=echo)
+        if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+            tune_sqlite(self.engine.sync_engine, mmap_size, cache_size)
+        self.Session = sessionmaker(bind=self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.executor = executor
+        self._write_lock = asyncio.Lock()
+
+    async def open(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(create_category_tables)
+        return self
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def _read(self, fn, *args, **kwargs):
+        async with self.Session() as session:
+            return await session.run_sync(fn, *args, **kwargs)
+
+    async def _write(self, fn, *args, **kwargs):
+        async with self._write_lock:
+            async with self.Session() as session:
+                try:
+                    result = await session.run_sync(fn, *args, **kwargs)
+                    await session.commit()
+                except:
+                    await session.rollback()
+                    raise
+                return result
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def groups(self):
+        return await self._read(lambda session: lookup_cache(session).groups())
+
+    async def load_data(self, **kwargs):
+        return await self._read(load_data, **kwargs)
+
+    async def load_columns(self, **kwargs):
+        return await self._read(load_columns, **kwargs)
+
+    async def load_subtree(self, id, include_self=False):
+        return await self._read(load_subtree, id, include_self=include_self)
+
+    # Group name -> id and load_data(**kwargs), queried concurrently
+    async def load(self, **kwargs):
+        return await asyncio.gather(self.groups(), self.load_data(**kwargs))
+
+    async def setup_tree_model(self, data, compact=False):
+        return await self._run(setup_tree_model, data, compact=compact)
+
+    async def search(self, tree, **kwargs):
+        return await self._run(tree.search, **kwargs)
+
+    async def add_new_category(self, **kwargs):
+        return await self._write(add_new_category, **kwargs)
+
+    async def modify_category(self, **kwargs):
+        return await self._write(modify_category, **kwargs)
+
+    async def delete_category(self, **kwargs):
+        return await self._write(delete_category, **kwargs)
+
+    async def apply_category_changes(self, operations, batch_size=5000):
+        return await self._write(apply_category_changes, operations, batch_size=batch_size)
+
+
+# Renderers yield one line at a time, so the first page of a large tree is
+# written without rendering the rest of it
+
+# Lines offset to offset + limit of lines
+def paginate(lines, limit=None, offset=0):
+    return itertools.islice(lines, offset, None if limit is None else offset + limit)
+
+
+# Writes one page of lines with writer (print by default), numbered from
+# offset + 1 if number is set
+def write_lines(lines, writer=None, limit=None, offset=0, number=False):
+    writer = writer or print
+    for i, line in enumerate(paginate(lines, limit, offset), offset + 1):
+        writer(f" {i:<5}   {line}" if number else line)
+
+
+HIGHLIGHT = '\033[0;33m{}\033[m'
+
+# Wraps each (start, end) span of text in fmt. Spans are sorted and do not overlap.
+def highlight(text, spans, fmt=HIGHLIGHT):
+    if not spans:
+        return text
+    parts = list()
+    last = 0
+    for start, end in spans:
+        parts.append(text[last:start])
+        parts.append(fmt.format(text[start:end]))
+        last = end
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+# Non-empty spans matched by a compiled regex
+def match_spans(regex, text):
+    return [m.span() for m in regex.finditer(text) if m.end() > m.start()]
 
 
 # TODO: Finish display
-def view_category_table(categories):
+def iter_category_table(categories):
 
     i = 1
 
@@ -485,49 +3321,60 @@ def view_category_table(categories):
         indent = path.count('/')
         name = (' ' * indent*4) + name
 
-        print(f"{i:>3} {id:4} {parent_id:3} {name:45}{path:45}{group:27}{has_tag:<5}{tag:5}")
+        yield f"{i:>3} {id:4} {parent_id:3} {name:45}{path:45}{group:27}{has_tag:<5}{tag:5}"
 
         i += 1
 
 
-def view_category_search(tree=None, pattern=None):
-    indent = 5
+def view_category_table(categories, writer=None, limit=None, offset=0):
+    write_lines(iter_category_table(categories), writer, limit, offset)
+
 
+# Each match of pattern with its ancestors and descendants, or the whole tree
+# without a pattern. Matches are highlighted in every line.
+def iter_category_search(tree=None, pattern=None, indent=5):
     if pattern is None:
-        text = view_descendent_hierarchy(node=tree.root, indent=indent)
-    else:
-        nodes = tree.search(name=pattern, path='node', comp=(lambda x,y: re.search(x,y)))
-        text = ''
-        for node in nodes:
-            level=0
-            level, txt = view_ancestor_hierarchy(node=node, indent=indent, level=level)
-            text += txt
-            text += view_descendent_hierarchy(node=node, pattern=pattern, indent=indent, level=level+1)
-    text = text.strip()
-    if pattern is not None:
-        text = text.replace(pattern, '\033[0;33m{}\033[m'.format(pattern))
-    categories = text.split('\n')
-    [print(f" {i+1:<5}   {categories[i]}") for i in range(0, len(categories))]
+        for level, node in iter_descendants(tree.root):
+            yield ' ' * indent*level + node.name
+        return
+
+    regex = re.compile(pattern)
+    mark = lambda name: highlight(name, match_spans(regex, name))
+    for node in tree.iter_search(pattern, prune=True):
+        parts = node.path_parts
+        for level, name in enumerate(parts):
+            yield ' ' * indent*level + mark(name)
+        for level, child in iter_descendants(node, level=len(parts) + 1):
+            yield ' ' * indent*level + mark(child.name)
+
+
+def view_category_search(tree=None, pattern=None, writer=None, limit=None, offset=0):
+    write_lines(iter_category_search(tree, pattern), writer, limit, offset, number=True)
 
 
 def view_ancestor_hierarchy(node=None, indent=0, pattern=None, level=0):
-    path = node.fullpath.split('/')[1:]
-    text = ''
-    for item in path:
-        text += ' ' * indent*level + item + '\n'
-        level+=1
-    return (level, text)
+    path = node.path_parts
+    text = ''.join(' ' * indent*(level + i) + item + '\n' for i, item in enumerate(path))
+    return (level + len(path), text)
 
 
 def view_descendent_hierarchy(node=None, indent=3, pattern=None, level=0):
-    return (
-        ''.join([
-            ' ' * indent*level + c.name
-            + '\n'
-            + view_descendent_hierarchy(node=c, indent=indent, pattern=pattern, level=level+1)
-            for c in node.children
-        ])
-    )
+    return ''.join(' ' * indent*l + c.name + '\n' for l, c in iter_descendants(node, level))
+
+
+# Pre-order (level, node) pairs below node, children of node at level. Uses
+# an explicit stack of child iterators so deep trees don't hit the recursion
+# limit.
+def iter_descendants(node, level=0):
+    stack = [(level, iter(node.children))]
+    while stack:
+        level, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            continue
+        yield level, child
+        stack.append((level + 1, iter(child.children)))
 
 
 def create_tc(categories):
@@ -554,18 +3401,25 @@ def create_tc(categories):
 #    b. for each item:
 #       1. create a new child node for item
 #       2. add child node to children nodes of current node
-def setup_tree_model(data):
+# values optionally maps item id -> {key: number} (see transaction_totals);
+# each node's totals sum them over its subtree.
+@instrumented('setup_tree_model', rows=len)
+def setup_tree_model(data, compact=False, values=None):
     parents = dict()
     for item in data:
         if item.parent_id not in parents:
             parents[item.parent_id] = list()
         parents[item.parent_id].append(item)
 
+    if compact:
+        return setup_compact_tree_model(parents)
+
     stack = list()
     tree = TreeModel()
     node = tree.root
     level = 0
     i = 0
+    nodes = list()
 
     while node is not None:
         key = node.key
@@ -575,6 +3429,9 @@ def setup_tree_model(data):
                 child = children[i]
                 n = Node(data=child, parent=node, name=child.name, level=level+1, key=child.id)
                 node.children.append(n)
+                tree.index_node(n, child.path)
+                nodes.append(n)
+                n.lft = 2 * len(nodes) - n.level
                 i += 1
                 if child.id in parents:
                     stack.append((node, i))
@@ -591,9 +3448,540 @@ def setup_tree_model(data):
                     node = None
             #   break to main loop
                 break
+
+    aggregate_nodes(nodes, values)
+    tree.root.lft = 0
+    tree.root.rgt = 2 * len(nodes) + 1
     return tree
 
 
+# Post-order pass filling in descendants, own, totals and the nested set rgt
+# (lft is numbered as the nodes are made). nodes are in pre-order, so walking
+# them backwards reaches every node after all of its descendants.
+def aggregate_nodes(nodes, values=None):
+    for n in reversed(nodes):
+        n.rgt = n.lft + 2 * n.descendants + 1
+        if values:
+            own = values.get(n.key)
+            if own:
+                n.own = dict(own)
+                n.totals = add_values(n.totals, own)
+        parent = n.parent
+        parent.descendants += n.descendants + 1
+        if n.totals:
+            parent.totals = add_values(parent.totals, n.totals)
+
+
+# Adds (or with sign=-1 subtracts) values into totals, making the dict if
+# totals is None. Returns totals.
+def add_values(totals, values, sign=1):
+    if totals is None:
+        totals = dict()
+    for key, value in values.items():
+        totals[key] = totals.get(key, 0) + sign * value
+    return totals
+
+
+def setup_lazy_tree_model(session, show_hidden=False):
+    return LazyTreeModel(session, show_hidden=show_hidden)
+
+
+# Same walk as setup_tree_model, filling a CompactTreeModel from the
+# parent_id -> [items] hash
+def setup_compact_tree_model(parents):
+    tree = CompactTreeModel()
+    todo = [(0, None)]
+    while todo:
+        index, key = todo.pop()
+        for child in parents.get(key, ()):
+            i = tree.append_node(index, child.name, child.id)
+            if child.id in parents:
+                todo.append((i, child.id))
+    tree.finish()
+    return tree
+
+
+# Build a CompactTreeModel straight from load_columns output (id, parent_id,
+# name and level columns) in one sort/group pass, with NumPy if it's
+# installed. Row i becomes node i+1; children keep their row order. Rows
+# whose parent isn't in the data (e.g. a path-filtered load) are attached to
+# the root. Nodes are only materialised as CompactNode handles when visited.
+@instrumented('setup_tree_model_columns', rows=len)
+def setup_tree_model_columns(columns):
+    ids = columns['id']
+    names = columns['name']
+    n = len(ids)
+
+    tree = CompactTreeModel()
+    if numpy is not None and n:
+        links = link_columns_numpy(ids, columns['parent_id'])
+        levels = numpy.fromiter(columns['level'], dtype=numpy.int32, count=n) + 1
+    else:
+        links = link_columns(ids, columns['parent_id'])
+        levels = [level + 1 for level in columns['level']]
+    parent, first_child, next_sibling, key_order = links
+
+    lookup = dict()
+    name_ids = [lookup.setdefault(name, len(lookup)) for name in names]
+
+    tree._parent = int_array(parent)
+    tree._first_child = int_array(first_child)
+    tree._next_sibling = int_array(next_sibling)
+    tree._last_child = None
+    tree._level = array('i', [0])
+    tree._level.extend(int_array(levels))
+    tree._name_ids = array('i', [-1])
+    tree._name_ids.extend(name_ids)
+    tree._names = list(lookup)
+    tree._name_lookup = lookup
+    tree._keys = array('q', [0])
+    tree._keys.extend(ids)
+    tree._key_order = int_array(key_order)
+    return tree
+
+
+# Returns parent, first_child and next_sibling node indexes (each n+1 long,
+# node 0 is the root) and node indexes sorted by id
+def link_columns(ids, parent_ids):
+    n = len(ids)
+    node_of = {id: i for i, id in enumerate(ids, 1)}
+    parent = [-1] + [node_of.get(p, 0) for p in parent_ids]
+    first_child = [-1] * (n+1)
+    next_sibling = [-1] * (n+1)
+    last_child = [-1] * (n+1)
+    for i in range(1, n+1):
+        p = parent[i]
+        if last_child[p] < 0:
+            first_child[p] = i
+        else:
+            next_sibling[last_child[p]] = i
+        last_child[p] = i
+    key_order = sorted(range(1, n+1), key=lambda i: ids[i-1])
+    return parent, first_child, next_sibling, key_order
+
+
+# Nested set numbers for the parent, first_child and next_sibling arrays
+# link_columns returns (node 0 is the root): a counter that goes up by gap on
+# the way into and out of each node. Returns lft and rgt lists, n+1 long.
+def euler_numbers(parent, first_child, next_sibling, gap=1):
+    lft = [0] * len(parent)
+    rgt = [0] * len(parent)
+    count = gap
+    i = first_child[0]
+    while i > 0:
+        lft[i] = count
+        count += gap
+        if first_child[i] > 0:
+            i = first_child[i]
+            continue
+        # leave i and any ancestors it was the last child of
+        while i > 0:
+            rgt[i] = count
+            count += gap
+            if next_sibling[i] > 0:
+                i = next_sibling[i]
+                break
+            i = parent[i]
+    rgt[0] = count
+    return lft, rgt
+
+
+def link_columns_numpy(ids, parent_ids):
+    n = len(ids)
+    ids = numpy.fromiter(ids, dtype=numpy.int64, count=n)
+    parent_ids = numpy.fromiter((-1 if p is None else p for p in parent_ids), dtype=numpy.int64, count=n)
+
+    # parent row by binary search of the sorted ids
+    order = numpy.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    pos = numpy.minimum(numpy.searchsorted(sorted_ids, parent_ids), n-1)
+    found = (parent_ids >= 0) & (sorted_ids[pos] == parent_ids)
+    parent = numpy.where(found, order[pos] + 1, 0)
+
+    # group children by parent; consecutive rows with the same parent are siblings
+    children = numpy.argsort(parent, kind='stable')
+    child_parent = parent[children]
+    children = children + 1
+    same = child_parent[1:] == child_parent[:-1]
+    next_sibling = numpy.full(n+1, -1, dtype=numpy.int64)
+    next_sibling[children[:-1][same]] = children[1:][same]
+    first = numpy.concatenate(([True], ~same))
+    first_child = numpy.full(n+1, -1, dtype=numpy.int64)
+    first_child[child_parent[first]] = children[first]
+
+    parent = numpy.concatenate(([-1], parent))
+    return parent, first_child, next_sibling, order + 1
+
+
+def int_array(values, typecode='i'):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        a = array(typecode)
+        a.frombytes(values.astype(numpy.dtype(typecode)).tobytes())
+        return a
+    return array(typecode, values)
+
+
+# Tree snapshots: a built tree with the data load_data returns for it
+# (ids, parent links, names, group, type, description, tag, has_tag, hidden;
+# paths are rebuilt from the parent links) written as one binary file that is
+# memory-mapped back in. The file is a 32 byte header (magic, byte order,
+# offset and length of a JSON trailer), then each array as raw native-order
+# bytes on an 8 byte boundary, and string tables as '\0' separated UTF-8.
+# The trailer holds the stamp, the load filters and where each section is.
+# Integer arrays are used straight from the mapping without copying.
+SNAPSHOT_MAGIC = b'CATSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sc7xqq')
+SNAPSHOT_HAS_TAG = 1
+SNAPSHOT_HIDDEN = 2
+
+
+# CompactTreeModel over a mapped snapshot. Node data is made on access.
+class SnapshotTreeModel(CompactTreeModel):
+    def __init__(self, mapping, meta):
+        super().__init__()
+        view = memoryview(mapping)
+        sections = dict()
+        for name, (offset, typecode, size, count) in meta['sections'].items():
+            data = view[offset:offset + size]
+            if typecode == 's':
+                sections[name] = str(data, 'utf-8').split('\0') if count else []
+            else:
+                sections[name] = data.cast(typecode)
+
+        self._mapping = mapping
+        self._parent = sections['parent']
+        self._first_child = sections['first_child']
+        self._next_sibling = sections['next_sibling']
+        self._last_child = None
+        self._level = sections['level']
+        self._name_ids = sections['name_ids']
+        self._keys = sections['keys']
+        self._key_order = sections['key_order']
+        self._names = sections['names']
+        self._name_lookup = {name: i for i, name in enumerate(self._names)}
+        self._group_ids = sections['group_ids']
+        self._groups = sections['groups']
+        self._type_ids = sections['type_ids']
+        self._types = sections['types']
+        self._tag_ids = sections['tag_ids']
+        self._tags = sections['tags']
+        self._description_ids = sections['description_ids']
+        self._descriptions = sections['descriptions']
+        self._flags = sections['flags']
+        self.stamp = meta['stamp']
+        self.filters = meta['filters']
+
+    def _data(self, i):
+        if i <= 0:
+            return None
+        parent = self._parent[i]
+        flags = self._flags[i]
+        return TransactionCat(
+            id = self._keys[i],
+            parent_id = self._keys[parent] if parent > 0 else None,
+            name = self._name(i),
+            path = self._node(i).fullpath,
+            type = self._string(self._types, self._type_ids[i]),
+            group = self._string(self._groups, self._group_ids[i]),
+            description = self._string(self._descriptions, self._description_ids[i]),
+            has_tag = bool(flags & SNAPSHOT_HAS_TAG),
+            tag = self._string(self._tags, self._tag_ids[i]),
+            hidden = bool(flags & SNAPSHOT_HIDDEN))
+
+    def _string(self, table, i):
+        return table[i] if i >= 0 else None
+
+
+# Writes data (as returned by load_data) as a snapshot for stamp and filters.
+# The file is replaced atomically, so readers see the old or the new one.
+@instrumented('write_snapshot', rows=lambda n: n)
+def write_snapshot(file, data, stamp, filters=None):
+    tree = setup_tree_model(data, compact=True)
+    by_id = {item.id: item for item in data}
+    items = [None] + [by_id[key] for key in tree._keys[1:]]
+
+    def intern(values):
+        lookup = dict()
+        ids = array('i', [-1])
+        ids.extend(-1 if v is None else lookup.setdefault(v, len(lookup)) for v in values)
+        return ids, list(lookup)
+
+    group_ids, groups = intern(item.group for item in items[1:])
+    type_ids, types = intern(item.type for item in items[1:])
+    tag_ids, tags = intern(item.tag for item in items[1:])
+    description_ids, descriptions = intern(item.description for item in items[1:])
+    flags = array('B', [0])
+    flags.extend((SNAPSHOT_HAS_TAG if item.has_tag else 0) | (SNAPSHOT_HIDDEN if item.hidden else 0)
+                 for item in items[1:])
+
+    sections = [
+        ('parent', tree._parent),
+        ('first_child', tree._first_child),
+        ('next_sibling', tree._next_sibling),
+        ('level', tree._level),
+        ('name_ids', tree._name_ids),
+        ('keys', tree._keys),
+        ('key_order', tree._key_order),
+        ('group_ids', group_ids),
+        ('type_ids', type_ids),
+        ('tag_ids', tag_ids),
+        ('description_ids', description_ids),
+        ('flags', flags),
+        ('names', tree._names),
+        ('groups', groups),
+        ('types', types),
+        ('tags', tags),
+        ('descriptions', descriptions),
+    ]
+
+    meta = dict(stamp=stamp, filters=snapshot_filters(filters), count=len(tree), sections=dict())
+    tmp = f"{file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(bytes(SNAPSHOT_HEADER.size))
+            for name, values in sections:
+                if isinstance(values, array):
+                    typecode, raw = values.typecode, values.tobytes()
+                else:
+                    typecode, raw = 's', '\0'.join(values).encode('utf-8')
+                meta['sections'][name] = (f.tell(), typecode, len(raw), len(values))
+                f.write(raw)
+                f.write(bytes(-f.tell() % 8))
+            trailer = json.dumps(meta).encode('utf-8')
+            offset = f.tell()
+            f.write(trailer)
+            f.seek(0)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, sys.byteorder[0].encode(), offset, len(trailer)))
+        os.replace(tmp, file)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(tree)
+
+
+# The snapshot in file as a SnapshotTreeModel, or None if it is missing,
+# unreadable, from a machine with the other byte order, or was written for a
+# different stamp or filters
+def open_snapshot(file, stamp, filters=None):
+    try:
+        with open(file, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, order, offset, length = SNAPSHOT_HEADER.unpack_from(mapping)
+        if magic == SNAPSHOT_MAGIC and order == sys.byteorder[0].encode():
+            meta = json.loads(mapping[offset:offset + length])
+            if meta['stamp'] == stamp and meta['filters'] == snapshot_filters(filters):
+                return SnapshotTreeModel(mapping, meta)
+    except (struct.error, ValueError, KeyError, TypeError):
+        pass
+    mapping.close()
+    return None
+
+
+# filters as they compare after a round trip through the JSON trailer
+def snapshot_filters(filters):
+    return json.loads(json.dumps(filters or {}, sort_keys=True))
+
+
+# Tree for load_data(session, **filters). Comes from the snapshot file if it
+# matches the current category version and filters; otherwise the data is
+# loaded, written to the snapshot and mapped back in. Databases with no
+# version row can't be checked, so their trees are always built from a load.
+@instrumented('load_tree', rows=len)
+def load_tree(session, snapshot, **filters):
+    stamp = category_version(session)
+    tree = open_snapshot(snapshot, stamp, filters) if stamp is not None else None
+    if tree is not None:
+        return tree
+    data = load_data(session, **filters)
+    if stamp is not None:
+        write_snapshot(snapshot, data, stamp, filters)
+        tree = open_snapshot(snapshot, stamp, filters)
+    return tree if tree is not None else setup_tree_model(data)
+
+
+# Columnar export of the flattened tree for analytics. Rows come from
+# category_tree_query (same filters as load_data) in path order and are
+# fetched batch_size at a time; each batch becomes one Arrow record batch or
+# NumPy structured array straight from the result tuples, without a
+# TransactionCat per row. pre and post number the rows in pre-order and
+# post-order, so B is below A exactly when pre[A] < pre[B] and
+# post[B] < post[A]. Rows whose parent isn't in the export are numbered as top
+# level categories. Both queries run in the session's transaction, so they
+# see the same rows.
+EXPORT_COLUMNS = ['id', 'parent_id', 'level', 'path', 'group', 'type', 'tag', 'hidden', 'pre', 'post']
+
+
+# Yields dicts of column name -> values (tuples, or NumPy arrays for pre and
+# post), one per batch
+def iter_export_batches(session, batch_size=65536, **filters):
+    query = category_tree_query(session, **filters)
+    exprs = {c['name']: c['expr'] for c in query.column_descriptions}
+    query = query.order_by(exprs['id'])
+
+    with stage('export.order') as stats:
+        links = session.execute(query.with_entities(exprs['id'], exprs['parent_id'], exprs['level']).statement).all()
+        stats.rows = len(links)
+        ids, parent_ids, levels = zip(*links) if links else ((), (), ())
+        del links
+        if numpy is not None and ids:
+            pre, post = tree_order_numpy(ids, parent_ids, levels)
+        else:
+            pre, post = tree_order(ids, parent_ids)
+        del ids, parent_ids, levels
+
+    names = EXPORT_COLUMNS[:-2]
+    result = session.execute(query.with_entities(*[exprs[name] for name in names]).statement,
+                             execution_options=dict(yield_per=batch_size))
+    start = 0
+    for rows in result.partitions(batch_size):
+        batch = dict(zip(names, zip(*rows)))
+        batch['pre'] = pre[start:start + len(rows)]
+        batch['post'] = post[start:start + len(rows)]
+        start += len(rows)
+        yield batch
+
+
+# Pre-order and post-order numbers of each row given ids and parent ids,
+# siblings numbered in row order
+def tree_order(ids, parent_ids):
+    parent, first_child, next_sibling, _ = link_columns(ids, parent_ids)
+    pre = [0] * len(ids)
+    post = [0] * len(ids)
+    entered = exited = 0
+    i = first_child[0]
+    while i > 0:
+        pre[i-1] = entered
+        entered += 1
+        if first_child[i] > 0:
+            i = first_child[i]
+            continue
+        # leave i and any ancestors it was the last child of
+        while i > 0:
+            post[i-1] = exited
+            exited += 1
+            if next_sibling[i] > 0:
+                i = next_sibling[i]
+                break
+            i = parent[i]
+    return pre, post
+
+
+# tree_order with a few vectorised passes per tree level instead of a walk.
+# levels is the CTE level column; a row's parent is always one level up, so
+# going level by level visits parents before children. Subtree sizes are
+# summed bottom up, then each row's pre number is its parent's plus one plus
+# the sizes of its earlier siblings. post follows from pre, the subtree size
+# and the number of ancestors.
+def tree_order_numpy(ids, parent_ids, levels):
+    n = len(ids)
+    parent = link_columns_numpy(ids, parent_ids)[0]
+    levels = numpy.fromiter(levels, dtype=numpy.int64, count=n)
+    order = numpy.argsort(levels, kind='stable')
+    bounds = numpy.flatnonzero(numpy.diff(levels[order])) + 1
+    by_level = numpy.split(order + 1, bounds)
+
+    size = numpy.ones(n+1, dtype=numpy.int64)
+    for nodes in reversed(by_level):
+        numpy.add.at(size, parent[nodes], size[nodes])
+
+    # sizes of earlier siblings, from a running sum over children grouped by parent
+    children = numpy.argsort(parent[1:], kind='stable') + 1
+    sizes = size[children]
+    before = numpy.cumsum(sizes) - sizes
+    first = numpy.concatenate(([True], parent[children[1:]] != parent[children[:-1]]))
+    offset = numpy.empty(n+1, dtype=numpy.int64)
+    offset[children] = before - before[first][numpy.cumsum(first) - 1]
+
+    pre = numpy.empty(n+1, dtype=numpy.int64)
+    depth = numpy.empty(n+1, dtype=numpy.int64)
+    pre[0] = depth[0] = -1
+    for nodes in by_level:
+        pre[nodes] = pre[parent[nodes]] + 1 + offset[nodes]
+        depth[nodes] = depth[parent[nodes]] + 1
+    post = pre + size - 1 - depth
+    return pre[1:], post[1:]
+
+
+# Writes the export to file as Parquet (one row group per batch) or, with
+# format='arrow', an Arrow IPC file. Returns the number of rows written.
+@instrumented('export_arrow', rows=lambda n: n)
+def export_arrow(session, file, format='parquet', batch_size=65536, **filters):
+    if pyarrow is None:
+        raise ImportError("export_arrow needs pyarrow")
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('parent_id', pyarrow.int64()),
+        ('level', pyarrow.int32()),
+        ('path', pyarrow.string()),
+        ('group', pyarrow.string()),
+        ('type', pyarrow.string()),
+        ('tag', pyarrow.string()),
+        ('hidden', pyarrow.bool_()),
+        ('pre', pyarrow.int64()),
+        ('post', pyarrow.int64()),
+    ])
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(file, schema)
+    elif format == 'arrow':
+        writer = pyarrow.ipc.new_file(file, schema)
+    else:
+        raise ValueError(f"Unknown export format: {format!r}")
+
+    count = 0
+    with writer:
+        for batch in iter_export_batches(session, batch_size, **filters):
+            arrays = [pyarrow.array(batch[field.name], type=field.type) for field in schema]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            count += len(batch['id'])
+    return count
+
+
+# Field types of the NumPy export. parent_id is -1 for top level categories,
+# and the string columns hold Python str objects.
+def export_dtype():
+    return numpy.dtype([
+        ('id', numpy.int64),
+        ('parent_id', numpy.int64),
+        ('level', numpy.int32),
+        ('path', object),
+        ('group', object),
+        ('type', object),
+        ('tag', object),
+        ('hidden', numpy.bool_),
+        ('pre', numpy.int64),
+        ('post', numpy.int64),
+    ])
+
+
+# The export as NumPy structured arrays, one per batch
+def iter_export_arrays(session, batch_size=65536, **filters):
+    if numpy is None:
+        raise ImportError("iter_export_arrays needs numpy")
+    dtype = export_dtype()
+    for batch in iter_export_batches(session, batch_size, **filters):
+        n = len(batch['id'])
+        arrays = numpy.empty(n, dtype=dtype)
+        for name in ['id', 'level', 'path', 'group', 'type', 'tag', 'pre', 'post']:
+            arrays[name] = batch[name]
+        arrays['parent_id'] = numpy.fromiter((-1 if p is None else p for p in batch['parent_id']),
+                                             dtype=numpy.int64, count=n)
+        arrays['hidden'] = numpy.fromiter((bool(h) for h in batch['hidden']), dtype=numpy.bool_, count=n)
+        yield arrays
+
+
+# All of iter_export_arrays in one structured array
+@instrumented('export_numpy', rows=len)
+def export_numpy(session, batch_size=65536, **filters):
+    arrays = list(iter_export_arrays(session, batch_size, **filters))
+    if not arrays:
+        return numpy.empty(0, dtype=export_dtype())
+    return numpy.concatenate(arrays)
+
+
 # Functions:
 # Search by pattern or all
 # Add
@@ -614,17 +4002,88 @@ def setup_tree_model(data):
 # delete
 # list all
 # search
-def main(file):
-    #engine = create_engine("sqlite:///categories.db", echo=True)
-    tables = [Base.metadata.tables['category'],
-              Base.metadata.tables['category_group']]
-    engine = create_engine("sqlite://", echo=False)
-    Base.metadata.create_all(engine, tables=tables)
-    session = Session(engine)
+# limit and offset page the table and the search output. With a snapshot
+# file the tree is loaded through load_tree.
+def main(file, url=None, profile=False, limit=None, offset=0, check=False, snapshot=None):
+    if check:
+        return check_main(file, limit, offset)
+    if profile:
+        return profile_main(file, url, limit, offset, snapshot)
+
+    store = CategoryStore(url)
+
+    # Only import into an empty database, so a persistent one is reused
+    with store.writer() as session:
+        if session.query(Category.id).first() is None:
+            import_example(session, file)
+    session = store.reader()
+
+    tree = None
+    if snapshot is None:
+        # TODO: move following two lines to separate function
+        data = load_data(session, show_hidden=True, group='Group A')
+    else:
+        tree = load_tree(session, snapshot, show_hidden=True, group='Group A')
+        data = [node.data for level, node in iter_descendants(tree.root)]
+    #categories = create_tc(data)
+    categories = data
+
+    view_category_table(sorted(categories, key=lambda x: x.path), limit=limit, offset=offset)
+    if tree is None:
+        tree = setup_tree_model(categories)
+
+    view_category_search(tree=tree, pattern='Cat 1', limit=limit, offset=offset)
+
+    print()
+    node = tree.search(name='Cat 1', path='branch')
+    print(node)
+    print(node.children[0].fullpath)
+    print(node.children[0].children[0].fullpath)
+    print(node.children[0].children[0].children[0].fullpath)
+    print(node.children[0].children[0].children[1].fullpath)
+
 
+# main with instrumentation on, followed by the per-stage report, the top
+# cProfile entries and the biggest tracemalloc allocation sites, on stderr
+def profile_main(file, url=None, limit=None, offset=0, snapshot=None):
+    inst = enable_instrumentation(memory=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        main(file, url, limit=limit, offset=offset, snapshot=snapshot)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        disable_instrumentation()
+        tracemalloc.stop()
+
+    print(file=sys.stderr)
+    print(inst.format(), file=sys.stderr)
+    print(file=sys.stderr)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    for stat in snapshot.statistics('lineno')[:10]:
+        print(stat, file=sys.stderr)
+
+
+# Parses file without a database, printing the hierarchy it describes and
+# any indentation errors. Returns the number of errors.
+def check_main(file, limit=None, offset=0):
+    errors = list()
+    records = read_hierarchy(file, on_error=errors.append)
+    lines = ('   ' * level + row[0].strip() for row, parent, level in records)
+    write_lines(lines, limit=limit, offset=offset, number=True)
+    for _ in records:
+        pass
+    for err in errors:
+        print(err)
+    return len(errors)
+
+
+def import_example(session, file):
     # Example group names
     grp_names = [ 'Group A', 'Group B', 'Group C', 'Group D', 'Group E', 'Group F', 'Group G' ]
-    build_tcg_table(session, grp_names)
+    if session.query(CategoryGroup.id).first() is None:
+        build_tcg_table(session, grp_names)
     import_csv(session, file)
 
     try:
@@ -647,31 +4106,38 @@ def main(file):
     modify_category(session, id=2, name='Modified category', type='Type B')
     session.commit()
 
-    # TODO: move following two lines to separate function
-    data = load_data(session, show_hidden=False, group='Group A')
-    #categories = create_tc(data)
-    categories = data
-
-    view_category_table(sorted(categories, key=lambda x: x.path))
-    tree = setup_tree_model(categories)
-
-    view_category_search(tree=tree, pattern='Cat 1')
-
-    print()
-    node = tree.search(name='Cat 1', path='branch')
-    print(node)
-    print(node.children[0].fullpath)
-    print(node.children[0].children[0].fullpath)
-    print(node.children[0].children[0].children[0].fullpath)
-    print(node.children[0].children[0].children[1].fullpath)
-
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <file>")
+    args = list()
+    profile = False
+    check = False
+    snapshot = None
+    limit = None
+    offset = 0
+    argv = iter(sys.argv[1:])
+    try:
+        for arg in argv:
+            if arg == '--profile':
+                profile = True
+            elif arg == '--check':
+                check = True
+            elif arg == '--limit':
+                limit = int(next(argv))
+            elif arg == '--offset':
+                offset = int(next(argv))
+            elif arg == '--snapshot':
+                snapshot = next(argv)
+            else:
+                args.append(arg)
+    except (StopIteration, ValueError):
+        args = list()
+
+    if len(args) < 1:
+        print(f"Usage: {sys.argv[0]} [--profile | --check] [--limit <n>] [--offset <n>] [--snapshot <file>] <file> [<database url>]")
         exit()
-    file = sys.argv[1]
+    file = args[0]
+    url = args[1] if len(args) > 1 else None
 
     if os.path.isdir(file):
         print(f"File {file} is a directory")
@@ -683,4 +4149,6 @@ if __name__ == "__main__":
         print(f"Cannot read {file}")
         exit()
 
-    main(file)
+    errors = main(file, url, profile, limit, offset, check, snapshot)
+    if check and errors:
+        exit(1)